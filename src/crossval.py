@@ -0,0 +1,118 @@
+from results_store import ResultsStore, read_frame, write_frame
+from sweep import train_model
+import evaluation as eval
+import pandas as pd
+import numpy as np
+import pickle
+import time
+import csv
+import os
+
+
+def load_alignments(alignments_file):
+    # Cached typo_counts(...) of the typo pairs, empty if there is no cache
+    if alignments_file is None or not os.path.exists(alignments_file):
+        return {}
+
+    with open(alignments_file, "rb") as f:
+        return pickle.load(f)
+
+
+def save_alignments(alignments, alignments_file):
+    with open(alignments_file, "wb") as f:
+        pickle.dump(alignments, f)
+
+
+def kfold_indices(n, k, seed=None):
+    # Indices of the test pairs of each of the k folds of n pairs, shuffled
+    rng = np.random.default_rng(seed)
+
+    return np.array_split(rng.permutation(n), k)
+
+
+def cross_validate(directory, words_ds, sentences_ds, typo_ds, k=5, seed=None, max_edits=2, max_states=5,
+                   alignments_file=None, export_csv=False, **options):
+    # k-fold cross validation of the error model on the typo pairs of typo_ds.
+    # The language model and the transitions don't depend on the typo pairs,
+    # so the model is trained once; every pair is aligned once (or read from
+    # alignments_file) and the error model of each fold is the sum of the
+    # counts of all the pairs less the ones of its test pairs (see
+    # HMM.train_error_model), its typo index reusing their alignments. Writes
+    # the tables of each fold prefixed with its number, and the accuracy of
+    # every fold with their mean as cross_validation, to the ResultsStore of
+    # directory (and to CSV files too with export_csv). options are passed to
+    # HMM.
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    alignments = load_alignments(alignments_file)
+    cached = len(alignments)
+
+    hmm, train_time = train_model(words_ds, sentences_ds, typo_ds, alignments=alignments, **options)
+    hmm.max_edits = max_edits
+    hmm.max_states = max_states
+
+    if alignments_file is not None and len(alignments) > cached:
+        save_alignments(alignments, alignments_file)
+
+    with open(typo_ds, "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        obs = [row for row in reader]
+
+    # Counts of all the pairs: each fold removes the ones of its test pairs
+    totals = hmm.sum_typo_counts(alignments[(elem[0], elem[1])] for elem in obs)
+
+    results = []
+
+    for n, test_indices in enumerate(kfold_indices(len(obs), k, seed), start=1):
+        print("### Fold {} of {}".format(n, k))
+
+        print("Starting error model training…")
+        start = time.time()
+
+        test = set(test_indices.tolist())
+        train_obs = [elem for i, elem in enumerate(obs) if i not in test]
+        test_obs = [obs[i] for i in sorted(test)]
+
+        train_counts = [alignments[(elem[0], elem[1])] for elem in train_obs]
+        test_counts = [alignments[(elem[0], elem[1])] for elem in test_obs]
+
+        hmm.train_error_model(train_obs, train_counts, totals=hmm.subtract_typo_counts(totals, test_counts))
+
+        end = time.time()
+        fold_train_time = end - start
+
+        print("Ended error model training in {:6.2f} seconds".format(fold_train_time))
+
+        test_filename = "{}/{}-typo_test.csv".format(directory, n)
+        prediction_typo_filename = "{}/{}-typo_prediction".format(directory, n)
+        meta_typo_filename = "{}/{}-meta_typo_prediction".format(directory, n)
+
+        with open(test_filename, "w", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(test_obs)
+
+        eval.prediction_hmm_candidate_test(test_filename, hmm, prediction_typo_filename, meta_typo_filename)
+        eval.evaluation_hmm_candidate_test(prediction_typo_filename, meta_typo_filename)
+
+        meta = read_frame(meta_typo_filename)
+        results.append({"fold": n, "train": len(train_obs), "test": len(test_obs),
+                        "train_time": fold_train_time,
+                        "accuracy_top_1": meta["accuracy_top_1"][0],
+                        "accuracy_top_3": meta["accuracy_top_3"][0],
+                        "accuracy_top_5": meta["accuracy_top_5"][0]})
+
+    r = pd.DataFrame(results)
+    mean = r.drop(columns="fold").mean()
+    r = pd.concat([r, pd.DataFrame([{"fold": "mean", **mean}])], ignore_index=True)
+
+    print("Mean accuracy_top_1: {:4.2f} %".format(mean["accuracy_top_1"]))
+    print("Mean accuracy_top_3: {:4.2f} %".format(mean["accuracy_top_3"]))
+    print("Mean accuracy_top_5: {:4.2f} %".format(mean["accuracy_top_5"]))
+
+    r = r.round(2)
+    write_frame(r, "{}/cross_validation".format(directory))
+
+    if export_csv:
+        ResultsStore(directory).export_csv()
+
+    return hmm, r
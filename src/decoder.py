@@ -0,0 +1,207 @@
+from trellis import Column, Trellis
+import itertools
+
+
+class Decoder:
+
+    def __init__(self, hmm, trellis=None, candidate_ids=None):
+        # Decoding state of one sequence on a trained HMM: its trellis. The
+        # model is only read, so any number of decoders (e.g. one for each
+        # thread) can share it. candidate_ids replaces hmm.candidate_ids(...)
+        # to find the states of a word, e.g. to reuse precomputed candidates.
+        self.hmm = hmm
+        self.candidate_ids = candidate_ids if candidate_ids is not None else hmm.candidate_ids
+        self.trellis = trellis if trellis is not None else Trellis()
+
+        return
+
+    def init_trellis(self):
+        self.trellis = Trellis()
+
+    def empty_trellis(self):
+        if len(self.trellis) == 0:
+            return True
+        else:
+            return False
+
+    def build_trellis(self, word):
+        states = self.context_candidate_ids(word)
+
+        if not states:
+            states = self.candidate_ids(word)
+
+        self.extend_trellis(word, states)
+
+    def context_candidate_ids(self, word):
+        # Candidates among the successors of the last states, if the model
+        # prunes with the context
+        if not self.hmm.context_pruning or self.empty_trellis():
+            return None
+
+        return self.hmm.context_candidate_ids(word, self.trellis.columns[-1].states)
+
+    def extend_trellis(self, word, states):
+        # Add the column of word with the given candidate states
+        metrics = self.hmm.metrics
+
+        if metrics is None:
+            self._build_trellis(word, states)
+        else:
+            with metrics.timer("trellis"):
+                self._build_trellis(word, states)
+
+            metrics.count("trellis_nodes", len(states))
+
+    def _build_trellis(self, word, states):
+        hmm = self.hmm
+        ids = [state for state, _ in states]
+
+        if self.empty_trellis():
+            # probability is P(intended|typed) = P(typed|intended)P(intended) where intended = state, typed = word
+            # We can use it as is
+            probs = [probability for _, probability in states]
+            back = [-1] * len(states)
+            edges = None
+        else:
+            # Last states
+            leaves = self.trellis.columns[-1]
+
+            probs = []
+            back = []
+            edges = []
+
+            for state, probability in states:
+                # probability is P(intended|typed) = P(typed|intended)P(intended) where intended = state, typed = word
+                # The emission probability of observation word for the current state is just P(typed|intended), extract
+                # it dividing by P(intended).
+                obs_prob = probability / hmm.prior(state)
+
+                best_leaf = -1
+                best_p = -1
+                weights = []
+
+                for k, leaf in enumerate(leaves.states):
+                    # Transition probability from the leaf state (previous one) to the current state, times the
+                    # previous state probability
+                    w = obs_prob * hmm.transition_probability(leaf, state)
+                    p = w * leaves.probs[k]
+
+                    weights.append((k, w))
+
+                    if p > best_p:
+                        best_leaf = k
+                        best_p = p
+
+                # Connecting a state to a leaf only if leaf->state is the path with the local maximal probability
+                probs.append(best_p)
+                back.append(best_leaf)
+
+                # All the edges are kept for the k-best paths, best first (ties in leaf order, like best_leaf)
+                edges.append(sorted(weights, key=lambda e: e[1] * leaves.probs[e[0]], reverse=True))
+
+        self.trellis.append(Column(hmm.reduce_lengthening(word.lower()), ids, probs, back, edges))
+
+    def most_likely_sequence(self, output_str=True):
+        return self.path_output(self.trellis.best_path(), output_str)
+
+    def most_likely_sequences(self, k, output_str=True):
+        # The k most likely sequences of the trellis with their probabilities,
+        # fewer if it has fewer paths. The first one is most_likely_sequence().
+        return [(self.path_output(path, output_str), probability)
+                for path, probability in itertools.islice(self.trellis.k_best_paths(), k)]
+
+    def path_output(self, path, output_str=True):
+        corrected_words = [self.hmm.state_word(column, k) for column, k in zip(self.trellis.columns, path)]
+
+        if output_str:
+            out = " ".join(corrected_words)
+        else:
+            # Return the list of corrected words and the list of node indices
+            out = corrected_words, self.trellis.node_ids(path)
+
+        return out
+
+    def predict_sequence(self, sequence, output_str=True):
+
+        self.init_trellis()
+
+        if isinstance(sequence, str):
+            words = sequence.split()
+        else:
+            words = sequence
+
+        for word in words:
+            self.build_trellis(word)
+
+        return self.most_likely_sequence(output_str)
+
+    def predict_sequences(self, sequence, k, output_str=True):
+        # Same as predict_sequence(...), with the k most likely sequences
+        self.init_trellis()
+
+        if isinstance(sequence, str):
+            words = sequence.split()
+        else:
+            words = sequence
+
+        for word in words:
+            self.build_trellis(word)
+
+        return self.most_likely_sequences(k, output_str)
+
+    async def predict_sequence_async(self, sequence, output_str=True):
+        # Same as predict_sequence(...), awaiting the candidates
+        self.init_trellis()
+
+        if isinstance(sequence, str):
+            words = sequence.split()
+        else:
+            words = sequence
+
+        for word in words:
+            states = self.context_candidate_ids(word)
+
+            if not states:
+                states = await self.hmm.candidate_ids_async(word)
+
+            self.extend_trellis(word, states)
+
+        return self.most_likely_sequence(output_str)
+
+    def stream_sequence(self, words, lag=None):
+        # Yield the corrected words of words (any iterable of words, e.g. read
+        # lazily from a file) as soon as they are settled: when all the paths
+        # still alive go through the same state, or when more than lag words
+        # are pending. Only the pending columns of the trellis are kept, so
+        # with a lag memory doesn't grow with the length of the input.
+        self.init_trellis()
+
+        # Leading columns of the trellis already yielded, 0 or 1
+        committed = 0
+
+        for word in words:
+            self.build_trellis(word)
+            self.trellis.rescale()
+
+            settled = self.trellis.coalesced()
+
+            if lag is not None and len(self.trellis) - committed > lag and (settled is None or
+                                                                             settled[0] < committed):
+                # Forced, the oldest pending word is the one on the best path so far
+                settled = (committed, self.trellis.best_path()[committed])
+
+            if settled is not None and settled[0] >= committed:
+                t, k = settled
+                path = self.trellis.path_to(t, k)
+
+                for column, j in zip(self.trellis.columns[committed:t + 1], path[committed:]):
+                    yield self.hmm.state_word(column, j)
+
+                self.trellis.commit(t, k)
+                committed = 1
+
+        if len(self.trellis) > committed:
+            path = self.trellis.best_path()
+
+            for column, j in zip(self.trellis.columns[committed:], path[committed:]):
+                yield self.hmm.state_word(column, j)
@@ -0,0 +1,68 @@
+from ngram_store import read_token_chunks
+from hmm import HMM
+import sys
+import re
+
+# Usage:
+#   python detect.py MODEL [INPUT] [--threshold=T] [--correct]
+# Writes offset, token and score of the tokens of INPUT (standard input by
+# default) likely misspelled, one per line separated by tabs. Offsets are in
+# characters from the start of the input. With --correct the candidates of
+# the flagged tokens are searched too, and written after them.
+
+# Tokens as left by the cleaning of the training texts (see
+# util.clean_sentences): runs of letters and digits, apostrophes removed
+# within them, any other character separating them
+token_pattern = re.compile(r"[a-zA-Z0-9]+(?:'+[a-zA-Z0-9]+)*")
+
+
+def read_tokens(f, chunk_size=1 << 20):
+    # (offset, token) of the tokens of f, read in chunks. The offset is the
+    # one of the first letter of the token in the text, so punctuation
+    # around it (e.g. "home." or "Yes!") is left out.
+    offset = 0
+
+    for chunk in read_token_chunks(f, chunk_size):
+        for match in token_pattern.finditer(chunk):
+            yield offset + match.start(), match.group().replace("'", "")
+
+        offset += len(chunk)
+
+
+def detect_file(hmm, f, threshold=1e-5, correct=False, chunk_size=1 << 20):
+    # Flagged tokens of f as (offset, token, score), with their candidates if
+    # correct. Only the flagged tokens go through candidates(...).
+    for offset, token, score in hmm.detect(read_tokens(f, chunk_size), threshold):
+        if correct:
+            yield offset, token, score, hmm.candidates(token)
+        else:
+            yield offset, token, score
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) if "=" in arg else (arg[2:], True)
+                   for arg in sys.argv[1:] if arg.startswith("--"))
+
+    threshold = float(options.get("threshold", 1e-5))
+    correct = "correct" in options
+
+    model = HMM.load(args[0], setup_pool=correct)
+
+    f = open(args[1], "r", encoding="utf-8") if len(args) > 1 else sys.stdin
+
+    try:
+        for flagged in detect_file(model, f, threshold, correct):
+            offset, token, score = flagged[:3]
+            line = "{}\t{}\t{:.3g}".format(offset, token, score)
+
+            if correct:
+                line += "\t" + " ".join(word for word, _ in flagged[3])
+
+            sys.stdout.write(line + "\n")
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+        if model.pool is not None:
+            model.pool.terminate()
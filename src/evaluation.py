@@ -1,3 +1,5 @@
+from results_store import read_frame, write_frame
+from decoder import Decoder
 import pandas as pd
 import numpy as np
 import pprint
@@ -5,7 +7,13 @@ import time
 import csv
 
 
-def prediction_hmm_candidate_test(typo_ds_test, hmm, prediction_typo_filename, meta_typo_filename):
+def prediction_hmm_candidate_test(typo_ds_test, hmm, prediction_typo_filename, meta_typo_filename, candidates=None):
+    # candidates replaces hmm.candidates(...), e.g. to reuse candidates
+    # computed for another experiment. Files ending in .csv are written as
+    # CSV, the others as tables of a ResultsStore (see write_frame)
+    if candidates is None:
+        candidates = hmm.candidates
+
     print("### HMM Candidates - Evaluation")
     print("Starting testing…")
     start = time.time()
@@ -27,19 +35,19 @@ def prediction_hmm_candidate_test(typo_ds_test, hmm, prediction_typo_filename, m
             real.append(el[1])
             perturbed.append(el[0])
 
-            candidates = hmm.candidates(el[0])
+            predicted = candidates(el[0])
 
             for idx in range(5):
-                if len(candidates) < idx + 1:
+                if len(predicted) < idx + 1:
                     observed[idx].append("")
                 else:
-                    observed[idx].append(candidates[idx][0])
+                    observed[idx].append(predicted[idx][0])
 
     end = time.time()
     test_time = end - start
     print("Ended testing in {:6.2f} seconds".format(test_time))
 
-    # save prediction to csv
+    # save prediction
     d = {'real': real,
          'perturbed': perturbed,
          'first_observed': observed[0],
@@ -49,16 +57,16 @@ def prediction_hmm_candidate_test(typo_ds_test, hmm, prediction_typo_filename, m
          'fifth_observed': observed[4]}
     prediction = pd.DataFrame(d)
 
-    prediction.to_csv(prediction_typo_filename, sep=',', index=False)
+    write_frame(prediction, prediction_typo_filename)
 
     m = {'observation': [iterator], 'test_time': [test_time]}
     meta = pd.DataFrame(m)
-    meta.to_csv(meta_typo_filename, sep=',', index=False)
+    write_frame(meta, meta_typo_filename)
 
 
 def evaluation_hmm_candidate_test(prediction_typo_filename, meta_typo_filename):
-    predictions = pd.read_csv(prediction_typo_filename)
-    meta = pd.read_csv(meta_typo_filename)
+    predictions = read_frame(prediction_typo_filename)
+    meta = read_frame(meta_typo_filename)
 
     print("Starting evaluation…")
     start = time.time()
@@ -96,10 +104,15 @@ def evaluation_hmm_candidate_test(prediction_typo_filename, meta_typo_filename):
     print("Accuracy_top_5: {:4.2f} %".format(accuracy_top5 * 100))
 
     meta = meta.round(2)
-    meta.to_csv(meta_typo_filename, sep=',', index=False)
+    write_frame(meta, meta_typo_filename)
+
 
+def prediction_hmm_sequence_test(sentences_ds, perturbed_ds, hmm, prediction_sentence_filename, meta_sentence_filename,
+                                 candidate_ids=None):
+    # candidate_ids replaces hmm.candidate_ids(...) when decoding (see
+    # Decoder)
+    decoder = Decoder(hmm, candidate_ids=candidate_ids)
 
-def prediction_hmm_sequence_test(sentences_ds, perturbed_ds, hmm, prediction_sentence_filename, meta_sentence_filename):
     print("### HMM Sequence Prediction - Evaluation")
 
     # Cleaning dataset
@@ -126,28 +139,28 @@ def prediction_hmm_sequence_test(sentences_ds, perturbed_ds, hmm, prediction_sen
                 break
 
             iterator += 1
-            corrected = hmm.predict_sequence(sentence)
+            corrected = decoder.predict_sequence(sentence)
             observed.append(corrected)
 
     end = time.time()
     test_time = end - start
     print("Ended testing in {:6.2f} seconds".format(test_time))
 
-    # save prediction to csv
+    # save prediction
     d = {'target': real[:iterator], 'perturbed': perturbed[:iterator], 'observed': observed}
 
     prediction = pd.DataFrame(d)
 
-    prediction.to_csv(prediction_sentence_filename, sep=',', index=False)
+    write_frame(prediction, prediction_sentence_filename)
 
     m = {'observation': [iterator], 'test_time': [test_time]}
     meta = pd.DataFrame(m)
-    meta.to_csv(meta_sentence_filename, sep=',', index=False)
+    write_frame(meta, meta_sentence_filename)
 
 
 def evaluation_hmm_sequence_test(prediction_sentence_filename, meta_sentence_filename, perturbed_ds):
-    predictions = pd.read_csv(prediction_sentence_filename)
-    meta = pd.read_csv(meta_sentence_filename)
+    predictions = read_frame(prediction_sentence_filename)
+    meta = read_frame(meta_sentence_filename)
 
     print("Starting evaluation…")
     start = time.time()
@@ -294,7 +307,7 @@ def evaluation_hmm_sequence_test(prediction_sentence_filename, meta_sentence_fil
     print("Word correction-precision: {:4.2f} %".format(correction_precision * 100))
     print("Word specificity: {:4.2f} %".format(specificity * 100))
 
-    predictions.to_csv(prediction_sentence_filename, sep=',', index=False)
+    write_frame(predictions, prediction_sentence_filename)
 
     meta['eval_time'] = eval_time
     meta['perturbed_ds'] = perturbed_ds
@@ -316,4 +329,4 @@ def evaluation_hmm_sequence_test(prediction_sentence_filename, meta_sentence_fil
     meta['specificity'] = specificity * 100
 
     meta = meta.round(2)
-    meta.to_csv(meta_sentence_filename, sep=',', index=False)
+    write_frame(meta, meta_sentence_filename)
@@ -0,0 +1,32 @@
+class FrozenMap(dict):
+
+    def __init__(self, items=(), default=None):
+        # Read-only dictionary. Looking up a missing key returns default
+        # without inserting it, unlike a defaultdict.
+        dict.__init__(self, items)
+        self.default = default
+
+        return
+
+    def __missing__(self, key):
+        return self.default
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("FrozenMap is read-only")
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __ior__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+    def __reduce__(self):
+        # The default pickling of dict subclasses restores the items with
+        # __setitem__
+        return FrozenMap, (dict(self), self.default)
+
+    def __repr__(self):
+        return "FrozenMap({}, default={!r})".format(dict.__repr__(self), self.default)
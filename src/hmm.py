@@ -1,16 +1,53 @@
 import multiprocessing
+import threading
+import asyncio
 from collections import Counter, OrderedDict, defaultdict
 import itertools
+import heapq
 import networkx as nx
 import edlib as el
 import pprint
 import csv
 import pickle
+import time
 import re
 
+from cache import LRUCache
+from decoder import Decoder
+from frozen import FrozenMap
+from lexicon import Lexicon, Vocabulary
+from neighbours import NeighbourIndex, reachable
+from ngram_store import NgramStoreBuilder, read_token_chunks
+from metrics import Metrics
+
 pp = pprint.PrettyPrinter(indent=4)
 
 
+def _set_result(future, result):
+    # Results of the pool for a cancelled (or timed out) call are dropped
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+def _resolve_threadsafe(loop, resolve, future, value):
+    # Callback of the pool, run by its result handler thread: an exception
+    # here kills the thread and every later call on the pool hangs. The loop
+    # of a timed out or cancelled call may be closed already.
+    if loop.is_closed() or future.done():
+        return
+
+    try:
+        loop.call_soon_threadsafe(resolve, future, value)
+    except RuntimeError:
+        # Closed since the check
+        pass
+
+
 def process_init(_hmm):
     global hmm
 
@@ -21,24 +58,81 @@ def process_init(_hmm):
 def process_map(input):
     global hmm
 
-    word, i, max_states, pid, nprocesses = input
+    word, i, pid, nprocesses, instrument = input
 
-    candidates = hmm.known(hmm.edits(word, i, pid, nprocesses))
+    # Each task collects its own metrics, which are merged by the caller
+    hmm.metrics = Metrics() if instrument else None
 
-    n_candidates = len(candidates)
-    results = [(c, hmm.compute_probability(typed=word, intended=c, n_candidates=n_candidates)) for c in candidates]
+    if hmm.metrics is None:
+        candidates = hmm.known_ids(hmm.edits(word, i, pid, nprocesses))
+    else:
+        with hmm.metrics.timer("edits"):
+            edits = list(hmm.edits(word, i, pid, nprocesses))
 
-    results = sorted(results, key=lambda c: c[1], reverse=True)
+        with hmm.metrics.timer("known"):
+            candidates = hmm.known_ids(edits)
 
-    # Conjecture: If each process returns `max_states` distinct results, then
-    # merging and deduplicating all the results will yield at least `max_states`
-    # globally distinct results.
-    return results[:max_states]
+        hmm.metrics.count("candidates_generated", len(edits))
+        hmm.metrics.count("known_hits", len(candidates))
+
+    # Candidates are scored by the caller, once all of them are known
+    if hmm.metrics is None:
+        return list(candidates.values()), None
+    else:
+        return list(candidates.values()), hmm.metrics.snapshot()
+
+
+class TopK:
+
+    def __init__(self, k):
+        # The k best distinct states, ordered by decreasing probability and
+        # then by increasing id (i.e. alphabetically). A state added more than
+        # once keeps its maximum probability, e.g. a generated candidate also
+        # found in the typo index.
+        self.k = k
+        self.heap = []
+        self.probs = {}
+
+        return
+
+    def __len__(self):
+        return len(self.heap)
+
+    def threshold(self):
+        # States with a lower probability can't enter anymore
+        if len(self.heap) < self.k:
+            return float("-inf")
+        else:
+            return self.heap[0][0]
+
+    def push(self, state, probability):
+        # The heap holds (probability, -state), its smallest item is the worst
+        old = self.probs.get(state)
+
+        if old is not None:
+            if probability <= old:
+                return
+
+            self.heap.remove((old, -state))
+            heapq.heapify(self.heap)
+        elif len(self.heap) == self.k:
+            if (probability, -state) <= self.heap[0]:
+                return
+
+            _, worst = heapq.heappop(self.heap)
+            del self.probs[-worst]
+
+        heapq.heappush(self.heap, (probability, -state))
+        self.probs[state] = probability
+
+    def items(self):
+        return sorted(self.probs.items(), key=lambda c: (-c[1], c[0]))
 
 
 class HMM:
 
-    def __init__(self, order, max_edits, max_states):
+    def __init__(self, order, max_edits, max_states, min_candidates=None, min_confidence=None, frequent_prob=None,
+                 context_pruning=False, cache_size=10000):
 
         # HMM parameters
         self.order = 1
@@ -46,43 +140,180 @@ class HMM:
         self.max_edits = max_edits
         self.max_states = max_states
 
-        # HMM structure
-        self.graph = defaultdict(self._graph_init)
-        self.trellis = nx.DiGraph()
-        self.trellis_depth = 0
+        # Probability of not mistaking a word for another when it's in the
+        # vocabulary, assumed to vary for different tasks
+        self.alpha = 0.98
+
+        # Adaptive edit depth: after each edit distance, the search goes on to
+        # the next one only if the candidates found so far are inconclusive,
+        # i.e. there are fewer than min_candidates of them or the best one has
+        # less than min_confidence of their total probability. Typed words in
+        # the language model with probability at least frequent_prob are never
+        # searched beyond distance 1. Criteria set to None are not checked, with
+        # all of them None every distance up to max_edits is always searched.
+        self.min_candidates = min_candidates
+        self.min_confidence = min_confidence
+        self.frequent_prob = frequent_prob
+
+        # When decoding a sequence, look for the candidates of a word first
+        # among the words that followed the previous states in training
+        self.context_pruning = context_pruning
 
         # Probability models
-        self.language_model = Counter()
+        self.language_model = Lexicon.from_items([])
         self.error_model = {}
 
+        # HMM structure, states are identified by their id in the vocabulary
+        self.vocabulary = Vocabulary(self.language_model)
+        self.graph = defaultdict(self._graph_init)
+
+        # Decoder of the calls made on the model itself, its trellis is the one
+        # of the last sequence predicted (see predict_sequence). Concurrent
+        # callers of init_trellis/build_trellis should use their own Decoder.
+        self.decoder = Decoder(self)
+
+        # Transition counts memory mapped from disk, used instead of graph when
+        # trained with an ngram_store (see train)
+        self.ngram_store = None
+
+        # Scored neighbours of the words of the language model, built offline
+        # (see build_neighbour_index)
+        self.neighbours = None
+
+        # Scored intended words of the misspellings observed in training
+        self.typo_index = {}
+
+        # Largest substitution probability and largest insertion or deletion
+        # probability in the error model, to bound the scores
+        self.max_sub_probability = 1
+        self.max_indel_probability = 1
+
+        # Instrumentation, disabled by default (see enable_metrics)
+        self.metrics = None
+
+        # Candidates of the most recently corrected words, shared by all the
+        # decoders. None to disable it.
+        self.cache = LRUCache(cache_size) if cache_size else None
+
         # Multiprocessing
-        # Do not initialize the pool here because it'd then throw an exception
-        # in save(...) since it can't be pickled.
+        # The pool is started on first use (or by load(...)), it's not pickled
+        # with the model (see __getstate__)
         self.pool = None
+        self.lock = threading.Lock()
 
         return
 
+    def __getstate__(self):
+        # The pool and the lock can't be pickled, and the trellis of the last
+        # call isn't part of the model
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["decoder"] = None
+        del state["lock"]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.decoder = Decoder(self)
+
+    @property
+    def trellis(self):
+        return self.decoder.trellis
+
     @staticmethod
-    def load(file):
+    def load(file, setup_pool=True):
         with open(file, "rb") as f:
             model = pickle.load(f)
+            model.neighbours = NeighbourIndex.read(file, f)
+
+        model.freeze()
 
         # Hide the latency of setting up the worker processes by starting them
         # before a request comes in.
-        model.setup_multiprocessing()
+        if setup_pool:
+            model.setup_multiprocessing()
 
         return model
 
     def save(self, file):
-        with open(file, "wb") as f:
-            pickle.dump(self, f)
+        # The neighbour index is written after the model, to be memory mapped
+        neighbours = self.neighbours
+        self.neighbours = None
+
+        try:
+            with open(file, "wb") as f:
+                pickle.dump(self, f)
+
+                if neighbours is not None:
+                    neighbours.write(f)
+        finally:
+            self.neighbours = neighbours
+
+    def build_neighbour_index(self, nprocesses=None):
+        # Precompute the candidates of every word of the language model, so
+        # that correcting a known word is a lookup. Their scores are the ones
+        # computed by candidates(...) searching all edit distances up to
+        # max_edits with a single process.
+        print("Starting building the neighbour index…")
+        start = time.time()
+
+        self.neighbours = NeighbourIndex.build(self, nprocesses)
+
+        end = time.time()
+        print("Ended building the neighbour index in {:6.2f} seconds".format(end - start))
+
+    def freeze(self):
+        # Convert the trained model into read-only structures, with explicit
+        # defaults for missing keys instead of defaultdicts that grow at
+        # every lookup (and make each worker's copy diverge). Lookups of
+        # missing states in the graph with .get(...) return None.
+        default = self._default_sub_probability()
+
+        error_model = {"p": self.error_model.get("p", 0)}
+
+        for edit in ("sub", "swap", "ins", "del"):
+            probs = self.error_model.get(edit, {})
+            error_model[edit] = FrozenMap(((char, FrozenMap(p, default=default)) for char, p in probs.items()),
+                                          default=FrozenMap(default=default))
+
+        self.error_model = FrozenMap(error_model)
+
+        # The graph doesn't change when only the error model is retrained
+        if not isinstance(self.graph, FrozenMap):
+            self.graph = FrozenMap((state, FrozenMap({"next": FrozenMap(node["next"], default=0),
+                                                      "total": node["total"],
+                                                      "obs": tuple(node["obs"])}))
+                                   for state, node in self.graph.items())
+
+        self.typo_index = FrozenMap(self.typo_index)
 
     def setup_multiprocessing(self):
-        if self.pool is None:
-            self.pool = multiprocessing.Pool(initializer=process_init, initargs=[self])
+        # Threads searching candidates at the same time start a single pool
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(initializer=process_init, initargs=[self])
+
+    def enable_metrics(self):
+        if self.metrics is None:
+            self.metrics = Metrics()
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def metrics_snapshot(self):
+        if self.metrics is None:
+            return None
+
+        return self.metrics.snapshot()
+
+    def write_metrics(self, file):
+        if self.metrics is not None:
+            self.metrics.write(file)
 
     def _graph_init(self):
-        return defaultdict(list)
+        return {"next": Counter(), "total": 0, "obs": []}
 
     def _default_sub_probability(self):
         return 1e-4
@@ -90,114 +321,205 @@ class HMM:
     def _error_model_sub_init(self):
         return defaultdict(self._default_sub_probability)
 
-    def train(self, words_ds, sentences_ds, typo_ds):
+    def train(self, words_ds, sentences_ds, typo_ds, ngram_store=None, chunk_size=1 << 22, alignments=None):
+        # With ngram_store set to a directory, the transition counts are
+        # written there out of core instead of being held in graph, so that
+        # sentences_ds doesn't need to fit in memory. alignments maps (typo,
+        # correct) pairs to their typo_counts(...): pairs found there aren't
+        # aligned again, the others are added to it.
+
+        # Importing the language model, either from a word,prob CSV or from the
+        # binary format written by util.build_language_model
+        if words_ds.endswith(".npz"):
+            self.language_model = Lexicon.load(words_ds)
+        else:
+            with open(words_ds, "r", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                self.language_model = Lexicon.from_items((row[0], float(row[1])) for row in reader)
 
-        # Training the hidden markov chain
-        with open(sentences_ds, "r", encoding="utf-8") as f:
-            words = f.read().split()
+        self.vocabulary = Vocabulary(self.language_model)
+        self.graph = defaultdict(self._graph_init)
+        self.ngram_store = None
 
-        for i in range(0, len(words) - self.state_len):
-            state = words[i: i + self.order][0]
-            next_s = words[i + self.order]
+        # Training the hidden markov chain
+        if ngram_store is not None:
+            self.ngram_store = self.build_ngram_store(sentences_ds, ngram_store, chunk_size)
+        else:
+            with open(sentences_ds, "r", encoding="utf-8") as f:
+                words = self.vocabulary.intern_many(f.read().split())
 
-            self.graph[state]["next"].append(next_s)
+            transitions = Counter(zip(words[:len(words) - self.state_len],
+                                      words[self.order:len(words) - self.state_len + self.order]))
 
-        # Importing the language model
-        with open(words_ds, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            lines = [row for row in reader]
-
-            for line in lines:
-                word = line[0]
-                self.language_model[word] = float(line[1])
+            for (state, next_s), count in transitions.items():
+                self.graph[state]["next"][next_s] += count
+                self.graph[state]["total"] += count
 
         # Training the error model
         with open(typo_ds, "r", encoding="utf-8") as f:
             reader = csv.reader(f)
             obs = [row for row in reader]
-            self.error_model = {"sub": defaultdict(self._error_model_sub_init),
-                                "swap": defaultdict(self._error_model_sub_init),
-                                "ins": defaultdict(self._error_model_sub_init),
-                                "del": defaultdict(self._error_model_sub_init),
-                                "p": 0}
-
-        ngram_counter = Counter()
 
-        correct_character_count = 0
+        if alignments is None:
+            alignments = {}
 
+        counts = []
         for elem in obs:
+            pair = (elem[0], elem[1])
 
-            typo = edited_typo = elem[0]
-            correct = elem[1]
+            if pair not in alignments:
+                alignments[pair] = self.typo_counts(*pair)
 
-            special = '[@_!#$%^&*()<>?/\\|}{~:]'
-            if any([x for x in correct if x in special]):
-                continue
-            if any([x for x in typo if x in special]):
+            counts.append(alignments[pair])
+
+        for elem, pair_counts in zip(obs, counts):
+            if pair_counts is None:
                 continue
 
-            # Editing typed string to account for accidental insertions, deletions and swaps to align letters, counting them:
-            # Ex: steet = st$eet (accidental deletion, index accounted by special char $)
-            #     mapes = maps (accidental insertion, index accounted by removing the extra char)
-            #     omeh = $ome (deletion + insertion)
+            correct_id = self.vocabulary.index(elem[1])
+            if correct_id in self.graph:
+                self.graph[correct_id]["obs"].append(elem[0])
 
-            edit_info = el.align(correct, typo, task="path")
-            cigar = edit_info["cigar"]
-            self.error_model["p"] += edit_info["editDistance"]
-            correct_character_count += len(correct)
+        self.train_error_model(obs, counts)
 
-            # If typo and correct share the same letters, are of the same length, and the cigar has one sequence of 1 deletion, 1 match and 1 insertion. that means there are only swap errors in the typo
-            if set(correct) == set(typo) and len(correct) == len(typo) and "1D1=1I" in cigar:
-                l = zip(edited_typo, correct)
+    def typo_counts(self, typo, correct):
+        # Edit operations aligning typo to correct, as counters of (typed,
+        # intended) characters for each kind of edit, with the n-grams of
+        # correct, the edit distance and the length of correct. None if the
+        # pair is left out of training. The error model is the normalized sum
+        # of the counts of the training pairs (see train_error_model), so they
+        # can be computed once and reused for different training sets.
+        counts = {"sub": Counter(), "swap": Counter(), "ins": Counter(), "del": Counter(), "ngrams": Counter(),
+                  "p": 0, "length": 0}
 
-                already_swapped = False
-                for i, j in l:
-                    if i != j and not already_swapped:
-                        self.error_model["swap"][j][i] += 1
-                        already_swapped = True
+        edited_typo = typo
+
+        special = '[@_!#$%^&*()<>?/\\|}{~:]'
+        if any([x for x in correct if x in special]):
+            return None
+        if any([x for x in typo if x in special]):
+            return None
+
+        # Editing typed string to account for accidental insertions, deletions and swaps to align letters, counting them:
+        # Ex: steet = st$eet (accidental deletion, index accounted by special char $)
+        #     mapes = maps (accidental insertion, index accounted by removing the extra char)
+        #     omeh = $ome (deletion + insertion)
+
+        edit_info = el.align(correct, typo, task="path")
+        cigar = edit_info["cigar"]
+        counts["p"] = edit_info["editDistance"]
+        counts["length"] = len(correct)
+
+        # The alignment, to score the pair in the typo index without aligning
+        # it again
+        counts["alignment"] = {"cigar": cigar, "editDistance": edit_info["editDistance"]}
+
+        # If typo and correct share the same letters, are of the same length, and the cigar has one sequence of 1 deletion, 1 match and 1 insertion. that means there are only swap errors in the typo
+        if set(correct) == set(typo) and len(correct) == len(typo) and "1D1=1I" in cigar:
+            l = zip(edited_typo, correct)
+
+            already_swapped = False
+            for i, j in l:
+                if i != j and not already_swapped:
+                    counts["swap"][j, i] += 1
+                    already_swapped = True
+                else:
+                    already_swapped = False
+
+        else:
+            pos = -1
+            edited_typo = typo
+
+            for idx, op in re.findall('(\d+)([IDX=])?', cigar):
+                idx = int(idx)
+                pos += idx
+
+                if op == "I":
+                    if pos == 1 or pos > len(correct):
+                        prev = "$"
                     else:
-                        already_swapped = False
+                        prev = correct[pos - 1]
 
-            else:
-                pos = -1
-                edited_typo = typo
+                    counts["del"][prev, correct[pos]] += 1
 
-                for idx, op in re.findall('(\d+)([IDX=])?', cigar):
-                    idx = int(idx)
-                    pos += idx
+                    edited_typo = edited_typo[:pos] + "$" * idx + edited_typo[pos:]
+                elif op == "D":
+                    if pos == 1 or pos > len(correct):
+                        prev = "$"
+                    else:
+                        prev = edited_typo[pos - 1]
 
-                    if op == "I":
-                        if pos == 1 or pos > len(correct):
-                            prev = "$"
-                        else:
-                            prev = correct[pos - 1]
+                    counts["ins"][prev, edited_typo[pos]] += 1
+                    edited_typo = edited_typo[:pos - idx] + edited_typo[pos:]
+                    pos -= idx
 
-                        self.error_model["del"][prev][correct[pos]] += 1
+            l = zip(edited_typo, correct)
+            for i, j in l:
+                if i == "$":
+                    continue
+                counts["sub"][i, j] += 1
 
-                        edited_typo = edited_typo[:pos] + "$" * idx + edited_typo[pos:]
-                    elif op == "D":
-                        if pos == 1 or pos > len(correct):
-                            prev = "$"
-                        else:
-                            prev = edited_typo[pos - 1]
+            ngrams = self.find_ngrams(correct, 1) + self.find_ngrams(correct, 2)
 
-                        self.error_model["ins"][prev][edited_typo[pos]] += 1
-                        edited_typo = edited_typo[:pos - idx] + edited_typo[pos:]
-                        pos -= idx
+            for gram in ngrams:
+                counts["ngrams"][gram] += 1
 
-                l = zip(edited_typo, correct)
-                for i, j in l:
-                    if i == "$":
-                        continue
-                    self.error_model["sub"][i][j] += 1
+        return counts
+
+    def sum_typo_counts(self, counts):
+        # Sum of the typo_counts(...) of some typo pairs, from which the error
+        # model is computed
+        totals = {"sub": Counter(), "swap": Counter(), "ins": Counter(), "del": Counter(), "ngrams": Counter(),
+                  "p": 0, "length": 0}
+
+        for pair_counts in counts:
+            if pair_counts is None:
+                continue
+
+            for key in ("sub", "swap", "ins", "del", "ngrams"):
+                totals[key].update(pair_counts[key])
+
+            totals["p"] += pair_counts["p"]
+            totals["length"] += pair_counts["length"]
+
+        return totals
+
+    def subtract_typo_counts(self, totals, counts):
+        # Sum totals of sum_typo_counts(...) without the counts of some of its
+        # pairs, e.g. the test pairs of a fold: cheaper than summing the others
+        # again when they are fewer. The counts are integers, the difference
+        # is exact.
+        removed = self.sum_typo_counts(counts)
+
+        return {key: totals[key] - removed[key] for key in totals}
+
+    def train_error_model(self, obs, counts, totals=None):
+        # Error model and typo index from the typo pairs obs and their counts
+        # computed by typo_counts(...). totals is sum_typo_counts(counts), if
+        # already known.
+        self.error_model = {"sub": defaultdict(self._error_model_sub_init),
+                            "swap": defaultdict(self._error_model_sub_init),
+                            "ins": defaultdict(self._error_model_sub_init),
+                            "del": defaultdict(self._error_model_sub_init),
+                            "p": 0}
 
-                ngrams = self.find_ngrams(correct, 1) + self.find_ngrams(correct, 2)
+        if totals is None:
+            totals = self.sum_typo_counts(counts)
 
-                for gram in ngrams:
-                    ngram_counter[gram] += 1
+        ngram_counter = totals["ngrams"]
+        self.error_model["p"] = totals["p"]
+        correct_character_count = totals["length"]
 
-            if correct in self.graph:
-                self.graph[correct]["obs"].append(typo)
+        for edit in ("sub", "swap", "ins", "del"):
+            for (i, j), n in totals[edit].items():
+                # Added one at a time on the default probability, rounding
+                # as if each edit was counted when found
+                probability = self.error_model[edit][i][j]
+
+                for _ in range(n):
+                    probability += 1
+
+                self.error_model[edit][i][j] = probability
 
         # Normalization
         unigrams_counter = [v for k, v in ngram_counter.items() if len(k) == 1]
@@ -236,114 +558,252 @@ class HMM:
 
         self.error_model["p"] /= correct_character_count
 
+        self.freeze()
+
+        self.max_sub_probability = max([self._default_sub_probability()] +
+                                       [p for probs in self.error_model["sub"].values() for p in probs.values()])
+        self.max_indel_probability = max([self._default_sub_probability()] +
+                                         [p for edit in ("ins", "del")
+                                          for probs in self.error_model[edit].values()
+                                          for p in probs.values()])
+
+        self.build_typo_index(obs, counts)
+
+        # Candidates cached, and the neighbour index scored, with the previous
+        # error model are stale: the index must be built again
+        if self.cache is not None:
+            self.cache.clear()
+
+        self.neighbours = None
+
+    def build_typo_index(self, obs, counts=None):
+        # Reverse index from the observed misspellings (normalized as in
+        # candidates(...)) to the known words they were meant to be. The
+        # alignments of the pairs kept in their counts by typo_counts(...) are
+        # reused to score them.
+        corrections = defaultdict(set)
+        alignments = {}
+
+        states = self.language_model.index_many([elem[1] for elem in obs]).tolist()
+
+        for elem, state, pair_counts in zip(obs, states, counts if counts is not None else itertools.repeat(None)):
+            typo = self.reduce_lengthening(elem[0].lower())
+            correct = elem[1]
+
+            if state != -1:
+                corrections[typo].add((state, correct))
+
+                if typo == elem[0] and pair_counts is not None and "alignment" in pair_counts:
+                    alignments[typo, correct] = pair_counts["alignment"]
+
+        self.typo_index = {}
+
+        typo_states = self.language_model.index_many(list(corrections)).tolist()
+
+        for (typo, intended), state in zip(corrections.items(), typo_states):
+            n_candidates = len(intended)
+
+            # A typo that is itself a known word is most often typed on
+            # purpose: it stays a candidate of itself, scored as by the search
+            if state != -1:
+                intended.add((state, typo))
+
+            scored = [(state, self.compute_probability(typed=typo, intended=correct, n_candidates=n_candidates,
+                                                       edit_info=alignments.get((typo, correct))))
+                      for state, correct in sorted(intended)]
+            scored.sort(key=lambda c: c[1], reverse=True)
+
+            self.typo_index[typo] = scored
+
+    def build_ngram_store(self, sentences_ds, directory, chunk_size=1 << 22):
+        # Count the transitions of sentences_ds reading it in chunks, with the
+        # same pairs as train(...) counts in memory
+        print("Starting n-gram store {} …".format(directory))
+        start = time.time()
+
+        builder = NgramStoreBuilder(directory)
+        carry = []
+
+        with open(sentences_ds, "r", encoding="utf-8") as f:
+            for chunk in read_token_chunks(f, chunk_size):
+                words = carry + self.vocabulary.intern_many(chunk.split())
+
+                # A pair is counted only when a word follows it, the pairs
+                # starting in the last two words wait for the next chunk
+                n = len(words) - self.state_len
+                if n > 0:
+                    builder.add(words[:n], words[self.order:n + self.order])
+
+                carry = words[max(n, 0):]
+
+        store = builder.close()
+
+        end = time.time()
+        print("Ended n-gram store in {:6.2f} seconds".format(end - start))
+
+        return store
+
+    def successors(self, state):
+        # Ids of the states that followed state in training
+        if self.ngram_store is not None:
+            return self.ngram_store.successors(state)[0].tolist()
+
+        node = self.graph.get(state)
+
+        return node["next"].keys() if node is not None else ()
+
     def init_trellis(self):
-        self.trellis.clear()
-        self.trellis_depth = 1
-        self.trellis.add_node(0, name="•")
+        self.decoder = Decoder(self)
+        self.decoder.init_trellis()
 
     def empty_trellis(self):
-        if len(self.trellis) == 1:
-            return True
-        else:
-            return False
+        return self.decoder.empty_trellis()
 
     def build_trellis(self, word):
-        states = self.candidates(word)
-        if self.empty_trellis():
-            for state, probability in states:
-                # probability is P(intended|typed) = P(typed|intended)P(intended) where intended = state, typed = word
-                # We can use it as is
-
-                new_id = len(self.trellis)
-                self.trellis.add_node(new_id, name=state, depth=self.trellis_depth)
-                self.trellis.add_edge(0, new_id, weight=probability)
+        self.decoder.build_trellis(word)
+
+    def context_candidate_ids(self, word, leaves, max_states=None):
+        # Candidates among the successors of the states leaves (the last ones
+        # of a trellis) within max_edits of word
+        word = self.reduce_lengthening(word.lower())
+
+        if max_states is None:
+            max_states = self.max_states
+
+        successors = set()
+        for leaf in leaves:
+            successors.update(self.successors(leaf))
+
+        # Only words of the language model the search could generate can be
+        # candidates
+        n_known = len(self.language_model)
+        known = ((state, self.vocabulary.word(state)) for state in successors if state < n_known)
+        candidates = [state for state, _ in reachable(self, word, known, self.max_edits)]
+
+        if self.metrics is not None:
+            self.metrics.count("context_hits" if candidates else "context_misses")
+
+        top = TopK(max_states)
+        self.score_candidates(word, candidates, top)
+
+        return top.items()
+
+    def transition_probability(self, prev, state):
+        if self.ngram_store is not None:
+            total = self.ngram_store.total(prev)
+            trans_freq = self.ngram_store.count(prev, state) if total > 0 else 0
         else:
-            # Get leaf nodes representing last states
-            leaves = [x for x, v in self.trellis.nodes(data=True)
-                      if self.trellis.out_degree(x) == 0
-                      and v["depth"] == self.trellis_depth - 1]
-
-            for state, probability in states:
-                p = {}
-                # probability is P(intended|typed) = P(typed|intended)P(intended) where intended = state, typed = word
-                # The emission probability of observation word for the current state is just P(typed|intended), extract
-                # it dividing by P(intended).
-                obs_prob = probability / self.P(state)
-
-                for leaf_id in leaves:
-                    leaf = self.trellis.node[leaf_id]["name"]
-
-                    # Transition probability from the leaf state (previous one) to the current state
-                    N_trans = len(self.graph[leaf]["next"])
-                    trans_freq = self.graph[leaf]["next"].count(state)
-                    if N_trans == 0 or trans_freq == 0:
-                        trans_prob = 1e-6
-                    else:
-                        trans_prob = trans_freq / N_trans
+            node = self.graph.get(prev)
 
-                    # Previous state probability
-                    predecessor = list(self.trellis.predecessors(leaf_id))
-                    # At one time there's always a single predecessor
-                    predecessor = predecessor[0]
-                    prev_state_prob = self.trellis.edges[predecessor, leaf_id]["weight"]
+            if node is None:
+                return 1e-6
 
-                    p[leaf_id] = obs_prob * trans_prob * prev_state_prob
+            total = node["total"]
+            trans_freq = node["next"].get(state, 0)
 
-                # Connecting a state to a leaf only if leaf->state is the path with the local maximal probability
-                max_key = max(p, key=p.get)
-                new_id = len(self.trellis)
-                self.trellis.add_node(new_id, name=state, depth=self.trellis_depth)
-                self.trellis.add_edge(max_key, new_id, weight=p[max_key])
+        if total == 0:
+            return 1e-6
 
-        self.trellis_depth += 1
+        if trans_freq == 0:
+            return 1e-6
+        else:
+            return trans_freq / total
 
-        # TODO: re-add a DEBUG flag if you need to enable this
-        # self.plot_trellis()
+    def transition_total(self, state):
+        # Number of transitions from state in training
+        if self.ngram_store is not None:
+            return self.ngram_store.total(state)
 
-    def most_likely_sequence(self, output_str=True):
+        node = self.graph.get(state)
+
+        return node["total"] if node is not None else 0
+
+    def detection_score(self, previous, state, following):
+        # Likelihood of state between the states previous and following (-1
+        # if there is none or it's unknown): 0 if it's not in the language
+        # model, otherwise the largest transition probability with a neighbour
+        # seen in training, 1 if there is none
+        if not 0 <= state < len(self.language_model):
+            return 0.0
+
+        score = None
 
-        leaves = [x for x, v in self.trellis.nodes(data=True)
-                  if self.trellis.out_degree(x) == 0
-                  and v["depth"] == self.trellis_depth - 1]
-
-        p = {}
-        for leaf_id in leaves:
-            # Previous state probability
-            predecessor = list(self.trellis.predecessors(leaf_id))
-            predecessor = predecessor[0]
-            prev_state_prob = self.trellis.edges[predecessor, leaf_id]["weight"]
-            p[leaf_id] = prev_state_prob
-
-        # Finding global maximum probability between last leaf states (Viterbi)
-        max_key = max(p, key=p.get)
-        seq = nx.shortest_path(self.trellis, source=0, target=max_key)
-        corrected_words = []
-
-        seq.pop(0)
-        for i in seq:
-            corrected_words.append(self.trellis.nodes[i]["name"])
-
-        if output_str:
-            out = " ".join(corrected_words)
+        if previous >= 0 and self.transition_total(previous) > 0:
+            score = self.transition_probability(previous, state)
+
+        if following >= 0 and self.transition_total(state) > 0:
+            score = max(score or 0.0, self.transition_probability(state, following))
+
+        return 1.0 if score is None else score
+
+    def detect(self, tokens, threshold=1e-5, batch_size=4096):
+        # Flag the tokens likely misspelled without searching any candidate:
+        # the ones not in the language model, and the known ones whose
+        # transitions with their neighbours are less likely than threshold.
+        # Unseen transitions have probability 1e-6, so by default a known word
+        # is flagged when it never followed the previous word nor preceded the
+        # next one in training. tokens is an iterable of (offset, token), e.g.
+        # read lazily from a file, looked up batch_size at a time; yields the
+        # (offset, token, score) of the flagged ones (see detection_score).
+        tokens = iter(tokens)
+
+        previous = -1
+        current = None
+
+        for batch in iter(lambda: list(itertools.islice(tokens, batch_size)), []):
+            words = [self.reduce_lengthening(token.lower()) for _, token in batch]
+
+            for (offset, token), state in zip(batch, self.vocabulary.index_many(words)):
+                if current is not None:
+                    score = self.detection_score(previous, current[2], state)
+
+                    if score < threshold:
+                        yield current[0], current[1], score
+
+                    previous = current[2]
+
+                current = (offset, token, state)
+
+        if current is not None:
+            score = self.detection_score(previous, current[2], -1)
+
+            if score < threshold:
+                yield current[0], current[1], score
+
+    def state_word(self, column, k):
+        # Words are converted back from ids only at the output. Unknown words
+        # (id -1) are left as they were typed, as in candidates(...)
+        state = column.states[k]
+
+        if state == -1:
+            return column.typed
         else:
-            # Return the list of corrected words and the list of node indices
-            out = corrected_words, seq
+            return self.vocabulary.word(state)
 
-        return out
+    def most_likely_sequence(self, output_str=True):
+        return self.decoder.most_likely_sequence(output_str)
+
+    def most_likely_sequences(self, k, output_str=True):
+        return self.decoder.most_likely_sequences(k, output_str)
 
     def predict_sequence(self, sequence, output_str=True):
+        # Each call decodes with its own Decoder, so threads can share the
+        # model. The last one is kept for plot_trellis(...).
+        decoder = Decoder(self)
+        out = decoder.predict_sequence(sequence, output_str)
+        self.decoder = decoder
 
-        self.init_trellis()
+        return out
 
-        if isinstance(sequence, str):
-            words = sequence.split()
-        else:
-            words = sequence
+    def predict_sequences(self, sequence, k, output_str=True):
+        decoder = Decoder(self)
+        out = decoder.predict_sequences(sequence, k, output_str)
+        self.decoder = decoder
 
-        for word in words:
-            self.build_trellis(word)
+        return out
 
-        return self.most_likely_sequence(output_str)
+    def stream_sequence(self, words, lag=None):
+        return Decoder(self).stream_sequence(words, lag)
 
     def edits(self, word, n=1, pid=None, nprocesses=None):
         if n == 1:
@@ -376,24 +836,46 @@ class HMM:
             return itertools.chain.from_iterable(self.edits(e1, n - 1) for e1 in self.edits(word, 1, pid, nprocesses))
 
     def known(self, words):
-        return set(w for w in words if w in self.language_model)
+        return set(self.known_ids(words))
+
+    def known_ids(self, words):
+        # Dictionary from the known words to their ids
+        words = list(words)
+        ids = self.language_model.index_many(words).tolist()
+
+        return {w: i for w, i in zip(words, ids) if i != -1}
 
     def P(self, word):
-        if word in self.language_model:
-            return self.language_model[word]
+        prob = self.language_model.get(word)
+
+        if prob is None:
+            return 1e-6
+        else:
+            return prob
+
+    def prior(self, state):
+        # Same as P(...), for a state id
+        if 0 <= state < len(self.language_model):
+            return self.language_model.prob(state)
         else:
             return 1e-6
 
-    def compute_probability(self, typed, intended, n_candidates):
+    def compute_probability(self, typed, intended, n_candidates, edit_info=None):
+        # edit_info is the alignment of intended and typed by edlib, if it's
+        # already known
 
-        edit_info = el.align(intended, typed, task="path")
-        cigar = edit_info["cigar"]
+        if edit_info is None:
+            if self.metrics is None:
+                edit_info = el.align(intended, typed, task="path")
+            else:
+                with self.metrics.timer("align"):
+                    edit_info = el.align(intended, typed, task="path")
+
+                self.metrics.count("alignments")
 
-        debug_words = []
-        enable_debug = (intended in debug_words)
-        components = []
+        cigar = edit_info["cigar"]
 
-        if not self.known([typed]):
+        if typed not in self.language_model:
             # Correcting non-word errors - typed word is not in the vocabulary
 
             prob = 1
@@ -410,9 +892,6 @@ class HMM:
                     if i != j and not already_swapped:
                         prob *= self.error_model["swap"][j][i]
                         already_swapped = True
-
-                        if enable_debug:
-                            components.append(("swap", j, i))
                     else:
                         already_swapped = False
 
@@ -435,9 +914,6 @@ class HMM:
                         edited = edited[:pos] + "$" * idx + edited[pos:]
                         prob *= self.error_model["del"][prev][intended[pos]]
 
-                        if enable_debug:
-                            components.append(("del", prev, intended[pos]))
-
                     elif op == "D":
                         if pos == 1 or pos > len(intended):
                             prev = "#"
@@ -445,9 +921,6 @@ class HMM:
                             prev = intended[pos - 1]
 
                         prob *= self.error_model["ins"][prev][edited[pos]]
-    
-                        if enable_debug:
-                            components.append(("ins", prev, edited[pos]))
 
                         edited = edited[:pos - idx] + edited[pos:]
                         pos -= idx
@@ -458,23 +931,14 @@ class HMM:
                         continue
                     prob *= self.error_model["sub"][i][j]
 
-                    if enable_debug:
-                        components.append(("sub", i, j))
-
                 # Boosting parameter to rank higher up candidates at shorter edit distances
                 parameter = 1 / (int(edit_info["editDistance"]) + 1)
                 prob *= self.P(intended) * parameter
 
-                if enable_debug:
-                    components.append(("prior", intended))
-                    components.append(("boost", parameter))
-
-
         else:
             # Correcting real-word errors - typed word is in the vocabulary
 
-            # Probability of mistaking a word for another, assumed to vary for different tasks
-            alpha = 0.98
+            alpha = self.alpha
 
             prob = 1
 
@@ -539,36 +1003,368 @@ class HMM:
                 parameter = 1 / (int(edit_info["editDistance"]) + 1)
                 prob *= self.P(intended) * parameter
 
-        if enable_debug:
-            print("P(intended=" + intended + "|typed=" + typed + ")=" + str(prob) + ", cigar: " + cigar + "\n" + str(components) + "\n")
-
         return prob
 
     def candidates(self, word, max_states=None):
-        self.setup_multiprocessing()
+        return self.candidate_words(word, self.candidate_ids(word, max_states))
+
+    def candidate_words(self, word, states):
+        # Candidates (state id, probability) of word as (word, probability)
+        return [(self.vocabulary.word(state) if state != -1 else self.reduce_lengthening(word.lower()), probability)
+                for state, probability in states]
+
+    def candidate_ids(self, word, max_states=None):
+        # Same as candidates(...), with state ids instead of words
+        key = self._cache_key(word, max_states)
+        cached = self._cache_get(key)
+
+        if cached is not None:
+            return cached
+
+        return self._cache_put(key, self._run_steps(self._candidate_steps(word, max_states)))
+
+    def candidate_levels(self, word, max_states=None):
+        # The candidates candidate_ids(...) would return with max_edits set to
+        # each of 1, ..., max_edits, computed with a single search
+        return self._run_steps(self._candidate_steps(word, max_states, levels=True))
+
+    def _run_steps(self, steps):
+        # Run a _candidate_steps(...) generator, searching with the pool
+        try:
+            request = next(steps)
+
+            while True:
+                request = steps.send(self._search_candidates(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    def _cache_key(self, word, max_states):
+        # The candidates depend on the search settings, which can be changed
+        # on a trained model
+        return (self.reduce_lengthening(word.lower()), max_states or self.max_states, self.max_edits,
+                self.min_candidates, self.min_confidence, self.frequent_prob)
+
+    def _cache_get(self, key):
+        if self.cache is None:
+            return None
+
+        cached = self.cache.get(key)
+
+        if self.metrics is not None:
+            self.metrics.count("cache_hits" if cached is not None else "cache_misses")
+
+        return list(cached) if cached is not None else None
+
+    def _cache_put(self, key, results):
+        if self.cache is not None:
+            self.cache.put(key, tuple(results))
+
+        return results
+
+    async def candidates_async(self, word, max_states=None, timeout=None):
+        # Same as candidates(...), awaiting the worker processes instead of
+        # blocking the event loop. Raises TimeoutError after timeout seconds.
+        return self.candidate_words(word, await self.candidate_ids_async(word, max_states, timeout))
+
+    async def candidate_ids_async(self, word, max_states=None, timeout=None):
+        if timeout is not None:
+            return await asyncio.wait_for(self.candidate_ids_async(word, max_states), timeout)
+
+        key = self._cache_key(word, max_states)
+        cached = self._cache_get(key)
 
+        if cached is not None:
+            return cached
+
+        steps = self._candidate_steps(word, max_states)
+
+        try:
+            request = next(steps)
+
+            while True:
+                request = steps.send(await self._search_candidates_async(*request))
+        except StopIteration as stop:
+            return self._cache_put(key, stop.value)
+
+    async def candidates_batch_async(self, words, max_states=None, timeout=None):
+        # Candidates of all the words, searched concurrently
+        return await self._batch((self.candidates_async(word, max_states) for word in words), timeout)
+
+    async def predict_sequence_async(self, sequence, output_str=True, timeout=None):
+        # Same as predict_sequence(...) without blocking the event loop, each
+        # call with its own Decoder
+        decoder = Decoder(self)
+
+        if timeout is None:
+            return await decoder.predict_sequence_async(sequence, output_str)
+        else:
+            return await asyncio.wait_for(decoder.predict_sequence_async(sequence, output_str), timeout)
+
+    async def predict_sequence_batch_async(self, sequences, output_str=True, timeout=None):
+        # Predictions of all the sequences, decoded concurrently
+        return await self._batch((self.predict_sequence_async(sequence, output_str) for sequence in sequences),
+                                 timeout)
+
+    async def _batch(self, calls, timeout=None):
+        # Await all the calls, cancelling the pending ones if one of them fails
+        # or the timeout expires
+        tasks = [asyncio.ensure_future(call) for call in calls]
+
+        try:
+            return await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _candidate_steps(self, word, max_states=None, levels=False):
+        # Body of candidate_ids(...) as a generator: it yields the (word, edit
+        # distance) pairs to search with the worker processes, is sent back
+        # the ids found and returns the candidates, so the same code runs
+        # blocking or awaiting the pool. With levels it returns the list of
+        # the candidates after each edit distance instead.
         word = self.reduce_lengthening(word.lower())
 
         if max_states is None:
             max_states = self.max_states
 
-        results = dict()
+        instrument = self.metrics is not None
+
+        # Known words are looked up in the neighbour index, if it was built
+        # for at least max_edits
+        indexed = -1
+        if self.neighbours is not None and self.neighbours.levels >= self.max_edits:
+            indexed = self.language_model.index(word)
+
+            if instrument and indexed != -1:
+                self.metrics.count("neighbour_hits")
+
+        # Observed misspellings are answered from the typo index. With the
+        # escalation thresholds, only if its candidates are conclusive: else
+        # they're merged with the generated ones.
+        observed = self.typo_index.get(word)
+
+        if observed is not None:
+            if instrument:
+                self.metrics.count("typo_index_hits")
+
+            if not self.has_thresholds() or not self.escalate(word, dict(observed)):
+                return [observed[:max_states]] * self.max_edits if levels else observed[:max_states]
+
+        if indexed == -1:
+            self.setup_multiprocessing()
+
+        # Known words found up to the current edit distance
+        found = set()
+        snapshots = []
+
         for i in range(1, self.max_edits + 1):
-            nprocesses = multiprocessing.cpu_count()
-            input = [(word, i, max_states, pid, nprocesses) for pid in range(nprocesses)]
+            # Exact top max_states of all the known words within distance i,
+            # scored with the number of candidates at i, as ranking them all
+            # would. The shorter distances found nothing more, since the
+            # edits at i include the ones at i - 1.
+            top = TopK(max_states)
+
+            if indexed != -1:
+                for state, probability in self.neighbours.lookup(indexed, i, max_states):
+                    top.push(state, probability)
+            else:
+                found |= (yield word, i)
+                self.score_candidates(word, found, top)
+
+            if levels:
+                # What the search would return stopping here
+                snapshot = TopK(max_states)
+                for state, probability in itertools.chain(top.items(), observed or ()):
+                    snapshot.push(state, probability)
+
+                snapshots.append(snapshot.items() or [(self.vocabulary.index(word), 1)])
 
-            subprocesses = self.pool.imap_unordered(process_map, input)
+            if i < self.max_edits:
+                escalate = self.escalate(word, top.probs)
 
-            for subprocess in subprocesses:
-                results.update(subprocess)
+                if instrument:
+                    self.metrics.count("escalation_checks")
+                    self.metrics.count("escalations", int(escalate))
 
-        results = sorted(results.items(), key=lambda c: c[1], reverse=True)
+                if not escalate:
+                    break
+
+        if levels:
+            # Distances not searched after a stop have the same candidates
+            return snapshots + [snapshots[-1]] * (self.max_edits - len(snapshots))
+
+        if observed is not None:
+            for state, probability in observed:
+                top.push(state, probability)
+
+        results = top.items()
 
         # If no word was found not in the language model, leave the typo as the only candidate
         if len(results) == 0:
-            results = [(word, 1)]
+            results = [(self.vocabulary.index(word), 1)]
+
+        return results
+
+    def _search_candidates(self, word, i):
+        # Ids of the known words at edit distance i, generated in parallel by
+        # the worker processes
+        instrument = self.metrics is not None
+
+        nprocesses = multiprocessing.cpu_count()
+        input = [(word, i, pid, nprocesses, instrument) for pid in range(nprocesses)]
+
+        if instrument:
+            start = time.perf_counter()
+
+        subprocesses = self.pool.imap_unordered(process_map, input)
+
+        candidates = set()
+        for subprocess, metrics in subprocesses:
+            candidates.update(subprocess)
+
+            if instrument:
+                self.metrics.merge(metrics)
+
+        if instrument:
+            self.metrics.add_time("pool", time.perf_counter() - start)
+            self.metrics.count("pool_round_trips", nprocesses)
+
+        return candidates
+
+    async def _search_candidates_async(self, word, i):
+        # Same as _search_candidates(...), each worker resolving a future on
+        # the event loop. Tasks already sent to the pool can't be stopped, if
+        # the call is cancelled their results are discarded.
+        loop = asyncio.get_running_loop()
+        instrument = self.metrics is not None
+
+        nprocesses = multiprocessing.cpu_count()
+
+        if instrument:
+            start = time.perf_counter()
+
+        futures = []
+        for pid in range(nprocesses):
+            future = loop.create_future()
+
+            self.pool.apply_async(process_map, ((word, i, pid, nprocesses, instrument),),
+                                  callback=lambda result, future=future: _resolve_threadsafe(
+                                      loop, _set_result, future, result),
+                                  error_callback=lambda exception, future=future: _resolve_threadsafe(
+                                      loop, _set_exception, future, exception))
+            futures.append(future)
+
+        candidates = set()
+        for subprocess, metrics in await asyncio.gather(*futures):
+            candidates.update(subprocess)
+
+            if instrument:
+                self.metrics.merge(metrics)
+
+        if instrument:
+            self.metrics.add_time("pool", time.perf_counter() - start)
+            self.metrics.count("pool_round_trips", nprocesses)
+
+        return candidates
+
+    def score_candidates(self, word, candidates, top):
+        # Add the candidates (state ids) for the typed word to top, skipping
+        # the ones whose upper bound can't beat the current k-th probability
+        n_candidates = len(candidates)
+        real_word = word in self.language_model
+
+        bounded = []
+        unbounded = []
+
+        for state in candidates:
+            intended = self.vocabulary.word(state)
+            bound = self.probability_bound(word, intended, state, n_candidates, real_word)
+
+            if bound is None:
+                unbounded.append((state, intended))
+            else:
+                bounded.append((bound, state, intended))
+
+        # The threshold rises faster considering the most promising first
+        bounded.sort(key=lambda c: c[0], reverse=True)
+
+        for state, intended in unbounded:
+            top.push(state, self.compute_probability(typed=word, intended=intended, n_candidates=n_candidates))
+
+        scored = len(unbounded)
+
+        for bound, state, intended in bounded:
+            # Bounds are sorted, none of the remaining candidates can enter
+            if bound < top.threshold():
+                break
+
+            top.push(state, self.compute_probability(typed=word, intended=intended, n_candidates=n_candidates))
+            scored += 1
+
+        if self.metrics is not None:
+            self.metrics.count("candidates_scored", scored)
+            self.metrics.count("candidates_pruned", n_candidates - scored)
+
+    def probability_bound(self, typed, intended, state, n_candidates, real_word):
+        # Upper bound of compute_probability(...) that doesn't need to align the
+        # words, None if there isn't one (e.g. swaps aren't weighted by the
+        # prior). The bounds are increased by a small margin for rounding errors.
+        if len(typed) == len(intended) and set(typed) == set(intended):
+            return None
+
+        prior = self.prior(state)
+
+        if real_word:
+            if typed == intended:
+                return prior * self.alpha * (1 + 1e-9)
+
+            # At least one edit, weighted by (1 - alpha) / n_candidates, and a
+            # boosting parameter 1 / (edit distance + 1) of at most 1/2
+            return prior * (1 - self.alpha) / n_candidates / 2 * (1 + 1e-9)
+
+        if "$" in typed:
+            return None
+
+        # With an edit distance d (at most 2 * max_edits, since a swap is two
+        # edits for the alignment): at most d insertion or deletion factors,
+        # at least len(intended) - d substitution factors, and a boosting
+        # parameter 1 / (d + 1)
+        indel = max(1, self.max_indel_probability)
+        bound = 0
+
+        for d in range(max(1, abs(len(typed) - len(intended))), 2 * self.max_edits + 1):
+            if self.max_sub_probability <= 1:
+                sub = self.max_sub_probability ** max(0, len(intended) - d)
+            else:
+                sub = self.max_sub_probability ** len(intended)
+
+            bound = max(bound, indel ** d * sub / (d + 1))
+
+        return prior * bound * (1 + 1e-9)
+
+    def has_thresholds(self):
+        # Whether any of the escalation thresholds is set
+        return self.min_candidates is not None or self.min_confidence is not None or self.frequent_prob is not None
+
+    def escalate(self, word, results):
+        # Whether the candidates found up to the current edit distance (a
+        # dictionary from state ids to probabilities) are inconclusive
+        if self.frequent_prob is not None and self.language_model.get(word, 0) >= self.frequent_prob:
+            return False
+
+        if self.min_candidates is None and self.min_confidence is None:
+            return True
+
+        if self.min_candidates is not None and len(results) < self.min_candidates:
+            return True
+
+        if self.min_confidence is not None:
+            total = sum(results.values())
+
+            if total == 0 or max(results.values()) / total < self.min_confidence:
+                return True
 
-        return results[:max_states]
+        return False
 
     def reduce_lengthening(self, word):
         pattern = re.compile(r"(.)\1{2,}")
@@ -582,7 +1378,7 @@ class HMM:
         from networkx.drawing.nx_agraph import graphviz_layout
 
         plt.figure(1)
-        G = self.trellis
+        G = self.trellis.to_networkx(self.state_word)
 
         labels = {e[0]: e[1]["name"] for e in G.nodes(data=True)}
         pos = graphviz_layout(G, prog='dot')
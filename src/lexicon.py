@@ -0,0 +1,267 @@
+import numpy as np
+
+
+# Binary language model format: a numpy .npz archive with the words sorted and
+# concatenated in a single UTF-8 blob, their offsets in the blob and their
+# probabilities.
+
+def save_language_model(file, items):
+    # items must be an iterable of (word, probability), sorted by word
+    blob = bytearray()
+    offsets = [0]
+    probs = []
+
+    for word, prob in items:
+        blob += word.encode("utf-8")
+        offsets.append(len(blob))
+        probs.append(prob)
+
+    with open(file, "wb") as f:
+        np.savez(f,
+                 blob=np.frombuffer(bytes(blob), dtype=np.uint8),
+                 offsets=np.asarray(offsets, dtype=np.int64),
+                 probs=np.asarray(probs, dtype=np.float64))
+
+
+def load_language_model(file):
+    with np.load(file) as data:
+        return data["blob"].tobytes(), data["offsets"], data["probs"]
+
+
+def iter_language_model(file):
+    blob, offsets, probs = load_language_model(file)
+    offsets = offsets.tolist()
+
+    for i, prob in enumerate(probs.tolist()):
+        yield blob[offsets[i]:offsets[i + 1]].decode("utf-8"), prob
+
+
+class Lexicon:
+
+    def __init__(self, blob, offsets, probs):
+        # Words sorted and concatenated in a single UTF-8 blob, the id of a word
+        # is its position in the sorted order
+        self.blob = blob
+        self.offsets = np.asarray(offsets, dtype=np.int32 if len(blob) < 2**31 else np.int64)
+        self.probs = np.asarray(probs, dtype=np.float32)
+
+        self._build_table()
+        self._setup_views()
+
+        return
+
+    @staticmethod
+    def from_items(items):
+        # Later occurrences of a word replace earlier ones, as in a dictionary
+        items = dict(items)
+
+        blob = bytearray()
+        offsets = [0]
+        probs = []
+
+        for word in sorted(items):
+            blob += word.encode("utf-8")
+            offsets.append(len(blob))
+            probs.append(items[word])
+
+        return Lexicon(bytes(blob), offsets, probs)
+
+    @staticmethod
+    def load(file):
+        return Lexicon(*load_language_model(file))
+
+    def _build_table(self):
+        # Open addressing hash table from the hash of a word to its id, with
+        # linear probing and a load factor of at most 1/2.
+        # Python's string hash is computed in C and cached by the strings
+        # themselves, but it's randomised for each interpreter: the table is
+        # never saved and is rebuilt when the lexicon is loaded.
+        n = len(self.probs)
+
+        size = 8
+        while size < 2 * n:
+            size *= 2
+
+        self.mask = size - 1
+        self.table = np.full(size, -1, dtype=np.int32)
+        self.hashes = np.empty(n, dtype=np.int64)
+
+        offsets = self.offsets.tolist()
+        table = self.table
+        mask = self.mask
+
+        for i in range(n):
+            h = hash(self.blob[offsets[i]:offsets[i + 1]].decode("utf-8"))
+            self.hashes[i] = h
+
+            slot = h & mask
+            while table[slot] != -1:
+                slot = (slot + 1) & mask
+
+            table[slot] = i
+
+    def _setup_views(self):
+        # Memoryviews are much faster than numpy arrays to index one item at a
+        # time from Python
+        self._table = memoryview(self.table)
+        self._hashes = memoryview(self.hashes)
+        self._offsets = memoryview(self.offsets)
+        self._probs = memoryview(self.probs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_table"], state["_hashes"], state["_offsets"], state["_probs"]
+        del state["table"], state["hashes"], state["mask"]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_table()
+        self._setup_views()
+
+    def __len__(self):
+        return len(self.probs)
+
+    def index(self, word):
+        # Id of word, or -1 if it's not in the lexicon
+        h = hash(word)
+        slot = h & self.mask
+
+        while True:
+            i = self._table[slot]
+
+            if i == -1:
+                return i
+
+            if self._hashes[i] == h and self.word(i) == word:
+                return i
+
+            slot = (slot + 1) & self.mask
+
+    def index_many(self, words):
+        # Vectorised version of index(...), words must be a list
+        hashes = np.fromiter(map(hash, words), dtype=np.int64, count=len(words))
+
+        result = np.full(len(words), -1, dtype=np.int64)
+        slots = hashes & self.mask
+        pending = np.arange(len(words))
+
+        while pending.size:
+            ids = self.table[slots[pending]]
+            occupied = ids != -1
+
+            pending = pending[occupied]
+            ids = ids[occupied]
+
+            # Only the ids with the same hash need a comparison of the strings
+            same_hash = self.hashes[ids] == hashes[pending]
+
+            found = np.zeros(len(pending), dtype=bool)
+            for k in np.flatnonzero(same_hash).tolist():
+                i = int(ids[k])
+                j = int(pending[k])
+
+                if self.word(i) == words[j]:
+                    result[j] = i
+                    found[k] = True
+
+            pending = pending[~found]
+            slots[pending] = (slots[pending] + 1) & self.mask
+
+        return result
+
+    def word(self, i):
+        return self.blob[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+    def prob(self, i):
+        return self._probs[i]
+
+    def __contains__(self, word):
+        return self.index(word) != -1
+
+    def get(self, word, default=None):
+        i = self.index(word)
+
+        if i == -1:
+            return default
+        else:
+            return self._probs[i]
+
+    def __getitem__(self, word):
+        # Same as the Counter it replaces, missing words have probability 0
+        return self.get(word, 0.0)
+
+    def __iter__(self):
+        return (self.word(i) for i in range(len(self)))
+
+    def items(self):
+        return ((self.word(i), self._probs[i]) for i in range(len(self)))
+
+    @property
+    def nbytes(self):
+        # Including the hash table, which is rebuilt on load
+        return len(self.blob) + self.offsets.nbytes + self.probs.nbytes + self.table.nbytes + self.hashes.nbytes
+
+
+class Vocabulary:
+
+    def __init__(self, lexicon):
+        # Integer ids for all the words known to a model: the words of the
+        # lexicon keep their lexicon ids, other words (e.g. seen only in the
+        # training sentences) get the following ones
+        self.lexicon = lexicon
+        self.extra_ids = {}
+        self.extra_words = []
+
+        return
+
+    def __len__(self):
+        return len(self.lexicon) + len(self.extra_words)
+
+    def index(self, word):
+        # Id of word, or -1 if it's unknown
+        i = self.lexicon.index(word)
+
+        if i == -1:
+            i = self.extra_ids.get(word, -1)
+
+        return i
+
+    def index_many(self, words):
+        # Vectorised version of index(...), words must be a list
+        ids = self.lexicon.index_many(words).tolist()
+
+        for k, i in enumerate(ids):
+            if i == -1:
+                ids[k] = self.extra_ids.get(words[k], -1)
+
+        return ids
+
+    def intern(self, word):
+        i = self.index(word)
+
+        if i == -1:
+            i = len(self)
+            self.extra_ids[word] = i
+            self.extra_words.append(word)
+
+        return i
+
+    def intern_many(self, words):
+        # Ids of a list of words, adding the unknown ones
+        ids = self.lexicon.index_many(words).tolist()
+
+        for k, i in enumerate(ids):
+            if i == -1:
+                ids[k] = self.intern(words[k])
+
+        return ids
+
+    def word(self, i):
+        n = len(self.lexicon)
+
+        if i < n:
+            return self.lexicon.word(i)
+        else:
+            return self.extra_words[i - n]
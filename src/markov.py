@@ -1,43 +1,212 @@
-import random
+from collections import Counter, defaultdict
+from sampling import AliasTable, RandomBuffer
+from ngram_store import NgramStoreBuilder, pack_histories, read_token_chunks
+import numpy as np
+import itertools
 
 
 class Markov:
 
-    def __init__(self, order, mode):
+    def __init__(self, order, mode, seed=None):
         self.order = order               # Order of the Markov chain
         self.state_len = self.order + 1  # Length of the grouping
-        self.text = None                 # Training text
-        self.graph = {}                  # State graph
-        self.mode = mode                 # Word or ngram
+        self.graph = {}                  # State graph, successor counts of each state
+        self.tables = {}                 # Sampling tables of the successors of each state
+        self.starts = None               # Sampling table of the states, by frequency
+        self.mode = mode                 # Word or ngram (characters)
+        self.store = None                # Successor counts on disk, instead of graph (see train)
+        self.tokens = []                 # Tokens of the store by id
+        self.token_ids = {}              # Ids of the tokens of the store
+        self.start_weights = None        # Cumulative totals of the histories of the store
+        self.random = RandomBuffer(np.random.default_rng(seed))
         return
 
-    def train(self, filename):
+    def tokenize(self, text):
+        if self.mode == "word":
+            return text.split()
+        elif self.mode == "ngram":
+            # Characters, with whitespace collapsed to single spaces
+            return list(" ".join(text.split()))
+        else:
+            raise ValueError("Unknown mode {}".format(self.mode))
+
+    def join(self, tokens):
+        if self.mode == "word":
+            return " ".join(tokens)
+        else:
+            return "".join(tokens)
+
+    def train(self, filename, ngram_store=None, chunk_size=1 << 22):
+        # With ngram_store set to a directory, the counts are written there
+        # reading filename in chunks instead of being held in graph
+        if ngram_store is not None:
+            return self.train_store(filename, ngram_store, chunk_size)
+
+        self.store = None
 
         with open(filename, "r") as f:
-            if self.mode == "word":
-                self.text = f.read().split()
-            # TODO: splitting text by ngram
+            text = self.tokenize(f.read())
 
         # Getting state and subsequent element
-        for i in range(0, len(self.text) - self.state_len):
-            key = tuple(self.text[i: i + self.order])
-            value = self.text[i + self.order]
+        n = len(text) - self.state_len
+        grams = Counter(zip(*(itertools.islice(text, k, k + n) for k in range(self.state_len))))
 
-            if key in self.graph:
-                self.graph[key].append(value)
-            else:
-                self.graph[key] = [value]
+        graph = defaultdict(Counter)
+        for gram, count in grams.items():
+            graph[gram[:-1]][gram[-1]] += count
 
-    def generate(self, length, starting_word=None):
+        self.graph = dict(graph)
+
+        # Alias tables make sampling O(1) regardless of the number of successors
+        self.tables = {state: AliasTable(list(successors.keys()), list(successors.values()))
+                       for state, successors in self.graph.items()}
+
+        states = list(self.graph)
+        self.starts = AliasTable(states, [sum(self.graph[s].values()) for s in states])
+
+    def token_chunks(self, f, chunk_size):
+        # Tokens of f, a chunk at a time. Chunks are cut on whitespace, which
+        # in ngram mode is a token of its own.
+        first = True
+
+        for chunk in read_token_chunks(f, chunk_size):
+            tokens = self.tokenize(chunk)
+
+            if tokens and self.mode == "ngram" and not first:
+                tokens.insert(0, " ")
+
+            first = first and not tokens
+
+            yield tokens
+
+    def train_store(self, filename, directory, chunk_size=1 << 22):
+        # States are numbered in base len(tokens), the digits being the ids of
+        # their tokens, so the tokens are read once before the counts
+        self.graph = {}
+        self.tables = {}
+        self.starts = None
+
+        self.tokens = []
+        self.token_ids = {}
+
+        with open(filename, "r") as f:
+            for tokens in self.token_chunks(f, chunk_size):
+                for token in tokens:
+                    if token not in self.token_ids:
+                        self.token_ids[token] = len(self.tokens)
+                        self.tokens.append(token)
+
+        if len(self.tokens) ** self.order >= 1 << 64:
+            raise ValueError("Too many tokens for states of order {}".format(self.order))
+
+        builder = NgramStoreBuilder(directory)
+        carry = []
+
+        with open(filename, "r") as f:
+            for tokens in self.token_chunks(f, chunk_size):
+                ids = carry + [self.token_ids[token] for token in tokens]
+
+                # Same grams as train(...): each one is counted only when a
+                # token follows it
+                n = len(ids) - self.state_len
+                if n > 0:
+                    builder.add(pack_histories(ids[:n + self.order - 1], self.order, len(self.tokens)),
+                                ids[self.order:n + self.order])
+
+                carry = ids[max(n, 0):]
+
+        self.store = builder.close()
+        self.start_weights = np.cumsum(self.store.totals)
+
+    def sample_store(self, cumulative, u):
+        # Index of the interval of cumulative counts where u falls
+        return int(np.searchsorted(cumulative, u * int(cumulative[-1]), side="right"))
+
+    def starting_state(self, starting_word=None):
+        if self.store is not None:
+            return self.starting_history(starting_word)
 
         if not starting_word:
-            index = random.randint(0, len(self.text) - self.order)
-            result = self.text[index: index + self.order]
-        # TODO: given starting_word case
+            return self.starts.sample(self.random.random())
+
+        # A state ending with the starting word (or with its last tokens, if
+        # it's longer than a state), chosen by frequency
+        tokens = tuple(self.tokenize(starting_word))[-self.order:]
+        states = [s for s in self.graph if s[len(s) - len(tokens):] == tokens]
+
+        if not states:
+            raise ValueError("No state ends with {!r}".format(starting_word))
 
-        for i in range(length):
-            state = tuple(result[len(result) - self.order:])
-            next_word = random.choice(self.graph[state])
-            result.append(next_word)
+        table = AliasTable(states, [sum(self.graph[s].values()) for s in states])
 
-        return " ".join(result[self.order:])
+        return table.sample(self.random.random())
+
+    def starting_history(self, starting_word=None):
+        # Same as starting_state(...) for states in the store
+        if len(self.store) == 0:
+            raise ValueError("Empty n-gram store")
+
+        if not starting_word:
+            k = self.sample_store(self.start_weights, self.random.random())
+            return int(self.store.histories[k])
+
+        tokens = self.tokenize(starting_word)[-self.order:]
+
+        if any(token not in self.token_ids for token in tokens):
+            raise ValueError("No state ends with {!r}".format(starting_word))
+
+        suffix = int(pack_histories([self.token_ids[token] for token in tokens], len(tokens), len(self.tokens))[0])
+        histories = np.flatnonzero(self.store.histories % np.uint64(len(self.tokens) ** len(tokens)) == suffix)
+
+        if len(histories) == 0:
+            raise ValueError("No state ends with {!r}".format(starting_word))
+
+        k = self.sample_store(np.cumsum(self.store.totals[histories]), self.random.random())
+
+        return int(self.store.histories[histories[k]])
+
+    def sample_successor(self, state):
+        # A successor of state chosen by frequency, None if it has none
+        if self.store is None:
+            table = self.tables.get(state)
+
+            return table.sample(self.random.random()) if table is not None else None
+
+        next_ids, counts = self.store.successors(state)
+
+        if len(next_ids) == 0:
+            return None
+
+        return self.tokens[int(next_ids[self.sample_store(np.cumsum(counts), self.random.random())])]
+
+    def next_state(self, state, token):
+        if self.store is None:
+            return state[1:] + (token,)
+
+        radix = len(self.tokens)
+
+        return state % radix ** (self.order - 1) * radix + self.token_ids[token]
+
+    def stream(self, length=None, starting_word=None):
+        # Lazily yield length tokens (or an endless sequence if length is
+        # None), starting with the tokens of starting_word if given
+        state = self.starting_state(starting_word)
+
+        if starting_word:
+            yield from self.tokenize(starting_word)
+
+        for _ in (range(length) if length is not None else itertools.count()):
+            token = self.sample_successor(state)
+
+            # States seen only at the end of the text have no successors,
+            # restart from a random one
+            if token is None:
+                state = self.starting_state()
+                token = self.sample_successor(state)
+
+            state = self.next_state(state, token)
+
+            yield token
+
+    def generate(self, length, starting_word=None):
+        return self.join(self.stream(length, starting_word))
@@ -0,0 +1,294 @@
+import multiprocessing
+import types
+import json
+import mmap
+import sys
+import os
+import numpy as np
+
+from hmm import HMM
+
+# Usage:
+#   python memory_report.py MODEL [REPORT.json] [--measure]
+#   python memory_report.py --diff OLD.json NEW.json
+# The report is added as "memory" to REPORT.json, keeping its other keys, so
+# that it can be tracked with the benchmark results. --measure also starts
+# the process pool and reads the memory of its workers from /proc (Linux).
+
+
+class Sizer:
+
+    def __init__(self, exclude=()):
+        # Deep sizes of objects, each object counted only the first time it's
+        # reached: an object shared by several components (e.g. the lexicon
+        # of the vocabulary) is part of the first one measured. Objects in
+        # exclude are never followed.
+        self.seen = {id(obj) for obj in exclude}
+
+        return
+
+    def size(self, obj):
+        # Bytes of obj and of everything it references, split into Python
+        # objects, array buffers in memory and memory mapped arrays
+        sizes = {"objects": 0, "buffers": 0, "mapped": 0}
+        stack = [obj]
+
+        while stack:
+            o = stack.pop()
+
+            if id(o) in self.seen:
+                continue
+            self.seen.add(id(o))
+
+            if isinstance(o, np.ndarray):
+                sizes["objects"] += sys.getsizeof(o) - (o.nbytes if o.flags.owndata else 0)
+
+                # The data belongs to the array at the root of the views
+                root = o
+                while isinstance(root.base, np.ndarray):
+                    root = root.base
+
+                if isinstance(root.base, mmap.mmap):
+                    if id(root.base) not in self.seen:
+                        self.seen.add(id(root.base))
+                        sizes["mapped"] += len(root.base)
+                elif root.base is not None:
+                    stack.append(root.base)
+                elif root is not o:
+                    stack.append(root)
+                else:
+                    sizes["buffers"] += o.nbytes
+
+                continue
+
+            if isinstance(o, (bytes, bytearray)):
+                sizes["buffers"] += sys.getsizeof(o)
+                continue
+
+            if isinstance(o, (type, types.ModuleType, types.FunctionType, types.MethodType,
+                              types.BuiltinFunctionType, mmap.mmap, memoryview)):
+                # Shared code, or views of buffers counted with their owner
+                if isinstance(o, memoryview):
+                    sizes["objects"] += sys.getsizeof(o)
+                continue
+
+            sizes["objects"] += sys.getsizeof(o)
+
+            if isinstance(o, dict):
+                stack.extend(o.keys())
+                stack.extend(o.values())
+            elif isinstance(o, (list, tuple, set, frozenset)):
+                stack.extend(o)
+
+            if hasattr(o, "__dict__"):
+                stack.append(o.__dict__)
+
+            for cls in type(o).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    if hasattr(o, slot):
+                        stack.append(getattr(o, slot))
+
+        sizes["total"] = sizes["objects"] + sizes["buffers"] + sizes["mapped"]
+
+        return sizes
+
+
+def component_sizes(hmm):
+    # Deep sizes of the parts of a model, in this order. The graph is split
+    # into the successors of the states, their observed typos and the rest of
+    # the nodes. other is whatever is left of the model.
+    sizer = Sizer(exclude=[hmm, hmm.pool])
+    graph = hmm.graph
+
+    components = {"graph_next": {"objects": 0, "buffers": 0, "mapped": 0, "total": 0},
+                  "graph_obs": {"objects": 0, "buffers": 0, "mapped": 0, "total": 0}}
+
+    for node in graph.values():
+        for key in ("next", "obs"):
+            for kind, n in sizer.size(node[key]).items():
+                components["graph_" + key][kind] += n
+
+    components["graph_nodes"] = sizer.size(graph)
+    components["language_model"] = sizer.size(hmm.language_model)
+    components["vocabulary"] = sizer.size(hmm.vocabulary)
+    components["error_model"] = sizer.size(hmm.error_model)
+    components["typo_index"] = sizer.size(hmm.typo_index)
+    components["neighbours"] = sizer.size(hmm.neighbours)
+    components["ngram_store"] = sizer.size(hmm.ngram_store)
+    components["trellis"] = sizer.size(hmm.decoder.trellis if hmm.decoder is not None else None)
+    components["cache"] = sizer.size(hmm.cache)
+    components["other"] = sizer.size(hmm.__dict__)
+
+    return components
+
+
+def entry_counts(hmm):
+    graph = hmm.graph
+    trellis = hmm.decoder.trellis if hmm.decoder is not None else None
+
+    counts = {"graph_states": len(graph),
+              "graph_transitions": sum(len(node["next"]) for node in graph.values()),
+              "graph_obs": sum(len(node["obs"]) for node in graph.values()),
+              "words": len(hmm.language_model),
+              "extra_words": len(hmm.vocabulary.extra_words),
+              "typo_index": len(hmm.typo_index),
+              "neighbours": len(hmm.neighbours.ids) if hmm.neighbours is not None else 0,
+              "ngram_histories": len(hmm.ngram_store) if hmm.ngram_store is not None else 0,
+              "ngram_records": len(hmm.ngram_store.next) if hmm.ngram_store is not None else 0,
+              "trellis_columns": len(trellis) if trellis is not None else 0,
+              "trellis_nodes": sum(len(column.states) for column in trellis.columns) if trellis is not None else 0,
+              "cache_entries": len(hmm.cache) if hmm.cache is not None else 0}
+
+    for edit in ("sub", "swap", "ins", "del"):
+        counts["error_model_" + edit] = sum(len(probs) for probs in hmm.error_model.get(edit, {}).values())
+
+    return counts
+
+
+def worker_estimate(components, start_method=None, nprocesses=None):
+    # Memory of each worker of the process pool holding a copy of the model.
+    # With fork the workers share the pages of the parent until they write
+    # them, and updating reference counts writes the pages of the Python
+    # objects they touch: at worst all of them become private, while array
+    # buffers and mapped files stay shared. With spawn (the default on macOS
+    # and Windows) each worker unpickles its own copy: everything is private
+    # except the n-gram store, mapped again from its directory, and the
+    # trellis and the cache aren't pickled (see HMM.__getstate__).
+    if start_method is None:
+        start_method = multiprocessing.get_start_method()
+    if nprocesses is None:
+        nprocesses = os.cpu_count()
+
+    if start_method == "fork":
+        private = sum(c["objects"] for c in components.values())
+        shared = sum(c["buffers"] + c["mapped"] for c in components.values())
+    else:
+        pickled = [c for name, c in components.items() if name not in ("ngram_store", "trellis", "cache")]
+        private = sum(c["total"] for c in pickled)
+        shared = components["ngram_store"]["mapped"]
+
+    parent = sum(c["total"] for c in components.values())
+
+    return {"start_method": start_method, "processes": nprocesses,
+            "private_bytes": private, "shared_bytes": shared,
+            "pool_total_bytes": parent + nprocesses * private}
+
+
+def measure_workers(hmm):
+    # Memory of the running workers of the pool of hmm, read from
+    # /proc/<pid>/smaps_rollup: resident, proportional (shared pages divided
+    # among the processes mapping them) and private. None if unavailable.
+    hmm.setup_multiprocessing()
+
+    # Warm the workers up with one search
+    hmm.candidates("teh")
+
+    workers = []
+    for process in multiprocessing.active_children():
+        try:
+            with open("/proc/{}/smaps_rollup".format(process.pid), "r") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line and not line.startswith(" "))
+        except OSError:
+            return None
+
+        kb = {key: int(value.split()[0]) * 1024 for key, value in fields.items() if value.strip().endswith("kB")}
+        workers.append({"pid": process.pid, "rss_bytes": kb.get("Rss", 0), "pss_bytes": kb.get("Pss", 0),
+                        "private_bytes": kb.get("Private_Clean", 0) + kb.get("Private_Dirty", 0)})
+
+    return sorted(workers, key=lambda w: w["pid"])
+
+
+def memory_report(hmm, measure=False):
+    components = component_sizes(hmm)
+
+    report = {"components": components,
+              "total": {kind: sum(c[kind] for c in components.values())
+                        for kind in ("objects", "buffers", "mapped", "total")},
+              "entries": entry_counts(hmm),
+              "workers": worker_estimate(components)}
+
+    if measure:
+        report["workers"]["measured"] = measure_workers(hmm)
+
+    return report
+
+
+def print_report(report):
+    print("{:<16} {:>12} {:>12} {:>12} {:>12}".format("component", "objects MB", "buffers MB", "mapped MB",
+                                                      "total MB"))
+
+    for name, c in list(report["components"].items()) + [("total", report["total"])]:
+        print("{:<16} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}".format(name, c["objects"] / 2**20,
+                                                                      c["buffers"] / 2**20, c["mapped"] / 2**20,
+                                                                      c["total"] / 2**20))
+
+    print()
+    for name, n in report["entries"].items():
+        print("{:<20} {:>12}".format(name, n))
+
+    workers = report["workers"]
+    print()
+    print("Workers ({}, {} processes): {:.2f} MB private, {:.2f} MB shared each, "
+          "{:.2f} MB with the parent".format(workers["start_method"], workers["processes"],
+                                             workers["private_bytes"] / 2**20, workers["shared_bytes"] / 2**20,
+                                             workers["pool_total_bytes"] / 2**20))
+
+    for worker in workers.get("measured") or []:
+        print("Worker {}: {:.2f} MB RSS, {:.2f} MB PSS, {:.2f} MB private".format(
+            worker["pid"], worker["rss_bytes"] / 2**20, worker["pss_bytes"] / 2**20,
+            worker["private_bytes"] / 2**20))
+
+
+def diff_reports(old, new):
+    # Changes of the sizes and the entry counts between two reports
+    for name in sorted(set(old["components"]) | set(new["components"])):
+        before = old["components"].get(name, {}).get("total", 0)
+        after = new["components"].get(name, {}).get("total", 0)
+
+        if before != after:
+            print("{:<20} {:>14,} -> {:>14,} bytes ({:+,})".format(name, before, after, after - before))
+
+    for name in sorted(set(old["entries"]) | set(new["entries"])):
+        before = old["entries"].get(name, 0)
+        after = new["entries"].get(name, 0)
+
+        if before != after:
+            print("{:<20} {:>12} -> {:>12} ({:+})".format(name, before, after, after - before))
+
+
+def write_report(report, file):
+    # Add the report to the JSON object in file, or create it
+    results = {}
+    if os.path.exists(file):
+        with open(file, "r") as f:
+            results = json.load(f)
+
+    results["memory"] = report
+
+    with open(file, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    if "--diff" in sys.argv:
+        with open(args[0], "r") as f:
+            old = json.load(f)
+        with open(args[1], "r") as f:
+            new = json.load(f)
+
+        diff_reports(old.get("memory", old), new.get("memory", new))
+    else:
+        model = HMM.load(args[0], setup_pool=False)
+
+        report = memory_report(model, measure="--measure" in sys.argv)
+        report["model"] = {"file": args[0], "file_bytes": os.path.getsize(args[0])}
+
+        print_report(report)
+
+        if len(args) > 1:
+            write_report(report, args[1])
+
+        if model.pool is not None:
+            model.pool.terminate()
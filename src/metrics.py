@@ -0,0 +1,82 @@
+from collections import Counter
+import threading
+import time
+
+
+class Metrics:
+
+    def __init__(self):
+        # Cumulative time (in seconds) spent in each stage and event counters
+        self.timers = Counter()
+        self.counters = Counter()
+
+        self.lock = threading.Lock()
+
+        return
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def add_time(self, stage, elapsed):
+        with self.lock:
+            self.timers[stage] += elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def merge(self, snapshot):
+        # Accumulate a snapshot produced by another Metrics instance (e.g. the
+        # one of a worker process) into this one
+        if snapshot is None:
+            return
+
+        with self.lock:
+            self.timers.update(snapshot["timers"])
+            self.counters.update(snapshot["counters"])
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {"timers": dict(self.timers), "counters": dict(self.counters)}
+
+    def write(self, file):
+        snapshot = self.snapshot()
+
+        with open(file, "w") as f:
+            for stage, elapsed in sorted(snapshot["timers"].items()):
+                f.write("time_{}_seconds {:.6f}\n".format(stage, elapsed))
+
+            for name, value in sorted(snapshot["counters"].items()):
+                f.write("{}_total {}\n".format(name, value))
+
+    def __getstate__(self):
+        # Locks can't be pickled
+        state = self.__dict__.copy()
+        del state["lock"]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class _Timer:
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,230 @@
+from collections import defaultdict
+import multiprocessing
+import itertools
+import pickle
+import numpy as np
+
+letters = set("abcdefghijklmnopqrstuvwxyz")
+
+
+def deletes(word, n):
+    # All the strings obtained deleting up to n characters from word
+    result = {word}
+    frontier = {word}
+
+    for _ in range(n):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        result |= frontier
+
+    return result
+
+
+def damerau_levenshtein(a, b):
+    # Edit distance with adjacent transpositions, where any character can be
+    # edited more than once (Lowrance-Wagner)
+    infinity = len(a) + len(b)
+    d = [[infinity] * (len(b) + 2)] + [[infinity] + [0] * (len(b) + 1) for _ in range(len(a) + 1)]
+
+    for i in range(len(a) + 1):
+        d[i + 1][1] = i
+    for j in range(len(b) + 1):
+        d[1][j + 1] = j
+
+    # Last row where each character of a was seen
+    last_row = {}
+
+    for i in range(1, len(a) + 1):
+        # Last column in this row where a[i - 1] matched
+        last_column = 0
+
+        for j in range(1, len(b) + 1):
+            k = last_row.get(b[j - 1], 0)
+            l = last_column
+
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                last_column = j
+            else:
+                cost = 1
+
+            d[i + 1][j + 1] = min(d[i][j] + cost,
+                                  d[i + 1][j] + 1,
+                                  d[i][j + 1] + 1,
+                                  d[k][l] + (i - k - 1) + 1 + (j - l - 1))
+
+        last_row[a[i - 1]] = i
+
+    return d[len(a) + 1][len(b) + 1]
+
+
+def within_edits(a, b, n):
+    # Whether b can be obtained from a with at most n of the edits generated by
+    # HMM.edits(...). Only valid if b is made of lowercase letters, since they
+    # are the only ones that can be inserted or replaced.
+    if abs(len(a) - len(b)) > n:
+        return False
+
+    return damerau_levenshtein(a, b) <= n
+
+
+def reachable(hmm, word, candidates, n):
+    # The candidates (state, intended word) that hmm.edits(word, n) generates,
+    # in their order: within_edits(...) decides for the ones made of lowercase
+    # letters, the others are looked up among the edits
+    edits = None
+    result = []
+
+    for c, intended in candidates:
+        if letters.issuperset(intended):
+            if within_edits(word, intended, n):
+                result.append((c, intended))
+        else:
+            if edits is None:
+                edits = set(hmm.edits(word, n))
+
+            if intended in edits:
+                result.append((c, intended))
+
+    return result
+
+
+def process_init(_hmm, _deletes):
+    global hmm, deletes_index
+
+    hmm = _hmm
+    deletes_index = _deletes
+
+
+def process_map(ids):
+    global hmm, deletes_index
+
+    lexicon = hmm.language_model
+    results = []
+
+    for i in ids:
+        word = lexicon.word(i)
+
+        # Words within max_edits of each other have a common string with up to
+        # max_edits deletions from each of them (symmetric delete)
+        candidates = set(itertools.chain.from_iterable(deletes_index.get(d, ()) for d in deletes(word, hmm.max_edits)))
+        candidates = [(c, lexicon.word(c)) for c in sorted(candidates)]
+
+        # One list for each edit distance, as computed by HMM.candidates(...)
+        # with a single process: all the known words within that distance
+        levels = []
+        for n in range(1, hmm.max_edits + 1):
+            neighbours = reachable(hmm, word, candidates, n)
+
+            n_candidates = len(neighbours)
+            scored = [(c, hmm.compute_probability(typed=word, intended=intended, n_candidates=n_candidates))
+                      for c, intended in neighbours]
+            scored.sort(key=lambda c: c[1], reverse=True)
+
+            levels.append(scored)
+
+        results.append((i, levels))
+
+    return results
+
+
+class NeighbourIndex:
+
+    def __init__(self, offsets, ids, scores):
+        # For each word i of the lexicon and each edit distance n, its
+        # neighbours within n edits sorted by decreasing probability are
+        # ids[offsets[i, n - 1]:offsets[i, n]], with the corresponding scores
+        self.offsets = offsets
+        self.ids = ids
+        self.scores = scores
+
+        self.levels = offsets.shape[1] - 1
+
+        return
+
+    @staticmethod
+    def build(hmm, nprocesses=None, chunk_size=256):
+        lexicon = hmm.language_model
+
+        deletes_index = defaultdict(list)
+        for i, word in enumerate(lexicon):
+            for d in deletes(word, hmm.max_edits):
+                deletes_index[d].append(i)
+
+        deletes_index = dict(deletes_index)
+
+        chunks = [range(begin, min(begin + chunk_size, len(lexicon))) for begin in range(0, len(lexicon), chunk_size)]
+        neighbours = [None] * len(lexicon)
+
+        with multiprocessing.Pool(nprocesses, initializer=process_init, initargs=[hmm, deletes_index]) as pool:
+            for results in pool.imap_unordered(process_map, chunks):
+                for i, levels in results:
+                    neighbours[i] = levels
+
+        lengths = np.array([[len(scored) for scored in levels] for levels in neighbours],
+                           dtype=np.int64).reshape(len(lexicon), hmm.max_edits)
+
+        ends = np.cumsum(lengths.ravel()).reshape(lengths.shape)
+        offsets = np.empty((len(lexicon), hmm.max_edits + 1), dtype=np.int64)
+        offsets[:, 1:] = ends
+        offsets[:, 0] = ends[:, 0] - lengths[:, 0]
+
+        total = int(offsets[-1, -1]) if len(lexicon) > 0 else 0
+        ids = np.fromiter((c for levels in neighbours for scored in levels for c, _ in scored),
+                          dtype=np.int32, count=total)
+        scores = np.fromiter((p for levels in neighbours for scored in levels for _, p in scored),
+                             dtype=np.float64, count=total)
+
+        return NeighbourIndex(offsets, ids, scores)
+
+    def lookup(self, i, n, max_states):
+        # Best max_states neighbours of word i within n edits
+        begin = int(self.offsets[i, n - 1])
+        end = min(int(self.offsets[i, n]), begin + max_states)
+
+        return list(zip(self.ids[begin:end].tolist(), self.scores[begin:end].tolist()))
+
+    # The arrays are stored after the pickle of the model in the same file, so
+    # that they can be memory mapped instead of being read when loading it.
+
+    def write(self, f, alignment=64):
+        arrays = {"offsets": self.offsets, "ids": self.ids, "scores": self.scores}
+
+        descriptors = {}
+        position = 0
+        for name, array in arrays.items():
+            descriptors[name] = (position, array.dtype.str, array.shape)
+            position += -(-array.nbytes // alignment) * alignment
+
+        pickle.dump(descriptors, f)
+
+        # Offsets are relative to the first aligned position after the descriptors
+        f.write(b"\0" * (-f.tell() % alignment))
+        start = f.tell()
+
+        for name, array in arrays.items():
+            f.write(b"\0" * (start + descriptors[name][0] - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+
+    @staticmethod
+    def read(file, f, alignment=64):
+        # Returns None if the file has no index
+        try:
+            descriptors = pickle.load(f)
+        except EOFError:
+            return None
+
+        start = f.tell() + (-f.tell() % alignment)
+
+        arrays = {}
+        for name, (position, dtype, shape) in descriptors.items():
+            if np.prod(shape) == 0:
+                # Empty regions can't be mapped
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file, dtype=np.dtype(dtype), mode="r", offset=start + position, shape=shape)
+
+        return NeighbourIndex(**arrays)
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.ids.nbytes + self.scores.nbytes
@@ -0,0 +1,294 @@
+import tempfile
+import shutil
+import json
+import os
+import numpy as np
+
+# Files of a store, all raw little endian arrays described by manifest.json
+columns = {"histories": "<u8",  # Distinct histories, sorted
+           "offsets": "<i8",    # Successors of histories[h] are next[offsets[h]:offsets[h + 1]]
+           "totals": "<u8",     # Sum of the counts of the successors of each history
+           "next": "<u4",       # Successor ids, sorted within each history
+           "counts": "<u4"}     # Count of each (history, next) pair
+
+
+def read_token_chunks(f, chunk_size):
+    # Read f in blocks of about chunk_size characters, cut on whitespace so
+    # that no token is split between two blocks
+    carry = ""
+
+    while True:
+        block = f.read(chunk_size)
+
+        if not block:
+            break
+
+        text = carry + block
+
+        # Last whitespace character of any kind (e.g. tabs), the ones that
+        # str.split() splits on
+        end = len(text) - 1
+        while end >= 0 and not text[end].isspace():
+            end -= 1
+
+        if end == -1:
+            carry = text
+        else:
+            yield text[:end]
+            carry = text[end:]
+
+    if carry:
+        yield carry
+
+
+def pack_histories(ids, order, radix):
+    # Number each history of order consecutive ids in base radix, the most
+    # recent id being the least significant digit. Returns one history for
+    # each position of ids from order - 1 on.
+    ids = np.asarray(ids, dtype=np.uint64)
+    n = len(ids) - order + 1
+
+    histories = np.zeros(max(n, 0), dtype=np.uint64)
+    for k in range(order):
+        histories = histories * np.uint64(radix) + ids[k:k + n]
+
+    return histories
+
+
+def _aggregate(histories, next_ids, counts):
+    # Sort the records by (history, next) and sum the counts of equal pairs
+    order = np.lexsort((next_ids, histories))
+    histories, next_ids, counts = histories[order], next_ids[order], counts[order]
+
+    if len(histories) == 0:
+        return histories, next_ids, counts
+
+    starts = np.flatnonzero(np.concatenate(([True], (histories[1:] != histories[:-1]) |
+                                                   (next_ids[1:] != next_ids[:-1]))))
+    counts = np.add.reduceat(counts.astype(np.uint64), starts)
+
+    return histories[starts], next_ids[starts], counts
+
+
+class NgramStoreBuilder:
+
+    def __init__(self, directory, run_size=1 << 24, spill_dir=None):
+        # Records are buffered, then sorted and spilled to disk as runs of at
+        # most run_size records, merged by close()
+        self.directory = directory
+        self.run_size = run_size
+        self.spill_directory = tempfile.mkdtemp(dir=spill_dir)
+        self.runs = []
+
+        self.buffer = []
+        self.buffered = 0
+
+        return
+
+    def add(self, histories, next_ids, counts=None):
+        histories = np.asarray(histories, dtype=np.uint64)
+        next_ids = np.asarray(next_ids, dtype=np.uint32)
+
+        if counts is None:
+            counts = np.ones(len(histories), dtype=np.uint64)
+        else:
+            counts = np.asarray(counts, dtype=np.uint64)
+
+        self.buffer.append((histories, next_ids, counts))
+        self.buffered += len(histories)
+
+        if self.buffered >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        if not self.buffer:
+            return
+
+        run = _aggregate(*(np.concatenate(column) for column in zip(*self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+
+        filenames = []
+        for name, array in zip(("histories", "next", "counts"), run):
+            filename = os.path.join(self.spill_directory, "run-{}-{}.npy".format(len(self.runs), name))
+            np.save(filename, array)
+            filenames.append(filename)
+
+        self.runs.append(filenames)
+
+    def _merge(self, block_size):
+        # k-way merge of the runs, reading block_size records of each at a time.
+        # Records smaller than the last one read from every run are complete,
+        # they are aggregated and yielded in order.
+        runs = [[np.load(f, mmap_mode="r") for f in filenames] for filenames in self.runs]
+        positions = [0] * len(runs)
+        pending = [tuple(np.empty(0, dtype=column.dtype) for column in run) for run in runs]
+
+        def read(i):
+            end = positions[i] + block_size
+            block = (np.array(column[positions[i]:end]) for column in runs[i])
+            pending[i] = tuple(np.concatenate((p, b)) for p, b in zip(pending[i], block))
+            positions[i] = min(end, len(runs[i][0]))
+
+        for i in range(len(runs)):
+            read(i)
+
+        while True:
+            # Runs with more to read bound what can be merged
+            bounds = [((int(p[0][-1]), int(p[1][-1])), i) for i, p in enumerate(pending)
+                      if positions[i] < len(runs[i][0])]
+
+            if not bounds:
+                yield _aggregate(*(np.concatenate(column) for column in zip(*pending)))
+                return
+
+            history, next_id = min(bounds)[0]
+
+            ready = []
+            for i, (histories, next_ids, counts) in enumerate(pending):
+                below = (histories < history) | ((histories == history) & (next_ids < next_id))
+                ready.append((histories[below], next_ids[below], counts[below]))
+                pending[i] = (histories[~below], next_ids[~below], counts[~below])
+
+            yield _aggregate(*(np.concatenate(column) for column in zip(*ready)))
+
+            for bound, i in bounds:
+                if bound == (history, next_id):
+                    read(i)
+
+    def close(self, block_size=1 << 20):
+        # Merge the runs into the store and open it
+        self._spill()
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = {name: open(os.path.join(self.directory, name + ".bin"), "wb") for name in columns}
+
+        try:
+            n_histories = 0
+            n_records = 0
+            last_history = None
+            last_total = 0
+
+            for histories, next_ids, counts in self._merge(block_size):
+                if len(histories) == 0:
+                    continue
+
+                if counts.max() > np.iinfo(np.uint32).max:
+                    raise OverflowError("n-gram count too large for the store")
+
+                files["next"].write(next_ids.astype("<u4").tobytes())
+                files["counts"].write(counts.astype("<u4").tobytes())
+
+                starts = np.flatnonzero(np.concatenate(([True], histories[1:] != histories[:-1])))
+                totals = np.add.reduceat(counts, starts)
+
+                # The first history may continue from the previous block
+                if int(histories[0]) == last_history:
+                    last_total += int(totals[0])
+                    starts, totals = starts[1:], totals[1:]
+
+                if len(starts) > 0:
+                    if last_history is not None:
+                        files["totals"].write(np.array([last_total], dtype="<u8").tobytes())
+
+                    files["histories"].write(histories[starts].astype("<u8").tobytes())
+                    files["offsets"].write((starts + n_records).astype("<i8").tobytes())
+                    files["totals"].write(totals[:-1].astype("<u8").tobytes())
+
+                    last_history = int(histories[-1])
+                    last_total = int(totals[-1])
+                    n_histories += len(starts)
+
+                n_records += len(histories)
+
+            if last_history is not None:
+                files["totals"].write(np.array([last_total], dtype="<u8").tobytes())
+
+            files["offsets"].write(np.array([n_records], dtype="<i8").tobytes())
+        finally:
+            for f in files.values():
+                f.close()
+
+            shutil.rmtree(self.spill_directory)
+
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            json.dump({"histories": n_histories, "records": n_records}, f)
+
+        return NgramStore(self.directory)
+
+
+class NgramStore:
+
+    def __init__(self, directory):
+        # Read-only n-gram counts, memory mapped from the files written by
+        # NgramStoreBuilder. Histories are found by binary search.
+        self.directory = os.path.abspath(directory)
+
+        with open(os.path.join(self.directory, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+
+        lengths = {"histories": manifest["histories"], "offsets": manifest["histories"] + 1,
+                   "totals": manifest["histories"], "next": manifest["records"], "counts": manifest["records"]}
+
+        for name, dtype in columns.items():
+            if lengths[name] == 0:
+                # Empty files can't be mapped
+                array = np.empty(0, dtype=dtype)
+            else:
+                array = np.memmap(os.path.join(self.directory, name + ".bin"), dtype=np.dtype(dtype), mode="r",
+                                  shape=(lengths[name],))
+
+            setattr(self, name, array)
+
+        return
+
+    def __len__(self):
+        return len(self.histories)
+
+    def __contains__(self, history):
+        return self._find(history) >= 0
+
+    def __reduce__(self):
+        # Pickled as the directory, mapped again when unpickled
+        return NgramStore, (self.directory,)
+
+    def _find(self, history):
+        # Index of history in histories, -1 if it's not there
+        if history < 0:
+            return -1
+
+        h = int(np.searchsorted(self.histories, history))
+
+        if h < len(self.histories) and self.histories[h] == history:
+            return h
+
+        return -1
+
+    def total(self, history):
+        h = self._find(history)
+
+        return int(self.totals[h]) if h >= 0 else 0
+
+    def successors(self, history):
+        # Successor ids of history and their counts
+        h = self._find(history)
+
+        if h < 0:
+            return self.next[:0], self.counts[:0]
+
+        begin, end = int(self.offsets[h]), int(self.offsets[h + 1])
+
+        return self.next[begin:end], self.counts[begin:end]
+
+    def count(self, history, next_id):
+        next_ids, counts = self.successors(history)
+        k = int(np.searchsorted(next_ids, next_id))
+
+        if k < len(next_ids) and next_ids[k] == next_id:
+            return int(counts[k])
+
+        return 0
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in columns)
@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
+import hashlib
+import inspect
+import json
+import time
+import os
+
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+class Stage:
+
+    def __init__(self, name, func, inputs, outputs, params=None):
+        # func is called as func(inputs, outputs, **params), where inputs and
+        # outputs are dictionaries from names to file paths. It must be defined
+        # at module level to be executed in a worker process.
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+
+        return
+
+    def key(self):
+        # Content hash of everything the outputs depend on
+        h = hashlib.sha256()
+        h.update(self.name.encode("utf-8"))
+        h.update(self.func.__module__.encode("utf-8"))
+        h.update(self.func.__qualname__.encode("utf-8"))
+
+        # Editing the stage function also invalidates its outputs (but editing
+        # the functions it calls doesn't)
+        try:
+            h.update(inspect.getsource(self.func).encode("utf-8"))
+        except (OSError, TypeError):
+            pass
+
+        h.update(json.dumps(self.params, sort_keys=True).encode("utf-8"))
+
+        for name, path in sorted(self.inputs.items()):
+            h.update(name.encode("utf-8"))
+            h.update(file_hash(path).encode("utf-8"))
+
+        return h.hexdigest()
+
+
+def run_stage(stage):
+    start = time.time()
+    stage.func(stage.inputs, stage.outputs, **stage.params)
+    end = time.time()
+
+    return end - start
+
+
+class Pipeline:
+
+    def __init__(self, stages, cache_dir):
+        self.stages = stages
+        self.cache_dir = cache_dir
+
+        names = [s.name for s in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Stage names must be unique")
+
+        # A stage depends on the stages producing its inputs
+        producers = {}
+        for stage in stages:
+            for path in stage.outputs.values():
+                if path in producers:
+                    raise ValueError("{} is produced by both {} and {}".format(path, producers[path].name, stage.name))
+                producers[path] = stage
+
+        self.dependencies = {stage.name: set(producers[path].name
+                                             for path in stage.inputs.values() if path in producers)
+                             for stage in stages}
+
+        return
+
+    def _manifest_file(self, stage):
+        return os.path.join(self.cache_dir, stage.name + ".json")
+
+    def _is_fresh(self, stage, key):
+        manifest_file = self._manifest_file(stage)
+
+        if not os.path.exists(manifest_file):
+            return False
+
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+
+        if manifest["key"] != key:
+            return False
+
+        # Outputs must still be there and must not have been modified
+        for path in stage.outputs.values():
+            if not os.path.exists(path) or manifest["outputs"].get(path) != file_hash(path):
+                return False
+
+        return True
+
+    def _write_manifest(self, stage, key, elapsed):
+        manifest = {"key": key,
+                    "outputs": {path: file_hash(path) for path in stage.outputs.values()},
+                    "time": elapsed}
+
+        with open(self._manifest_file(stage), "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+    def run(self, nprocesses=None, force=False):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        if nprocesses is None:
+            nprocesses = multiprocessing.cpu_count()
+
+        stages = {s.name: s for s in self.stages}
+        done = set()
+        running = {}
+        keys = {}
+
+        with ProcessPoolExecutor(nprocesses) as executor:
+            while len(done) < len(stages):
+                # Schedule every stage whose dependencies are satisfied. Stages
+                # found in the cache complete immediately, which may unlock
+                # others, so repeat until nothing changes.
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+
+                    for name, stage in stages.items():
+                        if name in done or name in running.values() or not self.dependencies[name] <= done:
+                            continue
+
+                        for path in stage.outputs.values():
+                            directory = os.path.dirname(path)
+                            if directory and not os.path.exists(directory):
+                                os.makedirs(directory)
+
+                        keys[name] = stage.key()
+
+                        if not force and self._is_fresh(stage, keys[name]):
+                            print("Skipping {}, up to date".format(name))
+                            done.add(name)
+                        else:
+                            print("Starting {} …".format(name))
+                            running[executor.submit(run_stage, stage)] = name
+
+                        scheduled = True
+
+                if not running:
+                    break
+
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in completed:
+                    name = running.pop(future)
+                    elapsed = future.result()
+
+                    self._write_manifest(stages[name], keys[name], elapsed)
+                    done.add(name)
+
+                    print("Ended {} in {:6.2f} seconds".format(name, elapsed))
@@ -1,114 +1,195 @@
 #!/usr/bin/python3.7
+from pipeline import Pipeline, Stage
 from hmm import HMM
 import util
 import pandas as pd
 import json
-import csv
 import os
 
 directory = "../data/typo/"
+clean_directory = directory + "clean/"
+texts_directory = "../data/texts/"
+perturbed_directory = texts_directory + "perturbed/"
+word_freq_directory = "../data/word_freq/"
+models_directory = "../data/models/"
 
-for filename in os.listdir(directory):
-    if filename.endswith(".txt"):
-        util.clean_dataset(directory, filename)
+noise_levels = [0.05, 0.10, 0.15, 0.20]
 
-clean_directory = directory + "clean/"
 
-combined_csv = pd.concat([pd.read_csv(clean_directory + f,
-                                      names=['misspelled_word', 'correct_word'])
-                          for f in os.listdir(clean_directory) if f.endswith(".csv")])
+def clean_typo_stage(inputs, outputs):
+    util.clean_dataset(os.path.dirname(inputs["typo"]) + "/", os.path.basename(inputs["typo"]))
+
+
+def split_typo_stage(inputs, outputs, seed):
+    # Words such as "nan" or "null" must not be read as missing values
+    combined_csv = pd.concat([pd.read_csv(f, names=['misspelled_word', 'correct_word'], header=None,
+                                          keep_default_na=False)
+                              for _, f in sorted(inputs.items())])
+
+    # Split the typo dataset into train and test
+    train, test = util.split_dataset(combined_csv, seed)
+
+    train.to_csv(outputs["train"], sep=',', header=None, index=False)
+    test.to_csv(outputs["test"], sep=',', header=None, index=False)
+
+
+def clean_big_stage(inputs, outputs):
+    # Read big.txt and extract a cleaned dataset
+    util.clean_sentences_file(inputs["raw"], outputs["clean"])
+
+
+def clean_lotr_stage(inputs, outputs):
+    # Read LordOfTheRingsBook.json and extract a cleaned dataset
+    with open(inputs["raw"]) as json_data:
+        d = json.load(json_data)
+        lotr = [chapter["ChapterData"] for chapter in d]
+        lotr = "\n".join(lotr)
+
+        lotr_cleaned = util.clean_sentences_dataset(lotr)
+
+    with open(outputs["clean"], mode="w") as outfile:
+        for r in lotr_cleaned:
+            outfile.write("%s\n" % r)
+
+
+def lotr_language_model_stage(inputs, outputs):
+    util.build_language_model(inputs["corpus"], outputs["model"], outputs["binary"])
+
+
+def big_language_model_stage(inputs, outputs):
+    # Clean big model language
+    frequency_alpha_gcide = pd.read_csv(inputs["frequencies"], sep="\t", header=None)
+
+    big_model_lang = pd.DataFrame()
+    big_model_lang['word'] = [x.split()[1] for x in frequency_alpha_gcide[0].tolist()]
+    big_model_lang['freq'] = frequency_alpha_gcide[2]
+    big_model_lang.to_csv(outputs["model"], sep=',', index=False, header=None)
+
+
+def train_model_stage(inputs, outputs):
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds=inputs["words"],
+              sentences_ds=inputs["sentences"],
+              typo_ds=inputs["typo"])
+    hmm.save(outputs["model"])
+
+
+def perturb_stage(inputs, outputs, seed):
+    # Create the model for the perturbation
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds=inputs["words"],
+              sentences_ds=inputs["sentences"],
+              typo_ds=inputs["typo"])
+
+    # Create the perturbed datasets, all the noise levels in a single pass
+    perturbed = [open(outputs["perturbed-{:.0%}".format(level)], "w") for level in noise_levels]
 
-# Split the typo dataset into train and test
-train, test = util.split_dataset(combined_csv)
+    with open(inputs["sentences"], "r") as cleaned:
+        util.perturb_files(perturbed, noise_levels, cleaned, hmm, seed)
 
-train.to_csv(directory + "clean/big_train.csv", sep=',', header=None, index=False)
-test.to_csv(directory + "clean/big_test.csv", sep=',', header=None, index=False)
 
-# Read big.txt and extract a cleaned dataset
-big_file = "../data/texts/big.txt"
-lotr_file = "../data/texts/LordOfTheRingsBook.json"
+def typo_corpus_stage(inputs, outputs, seed):
+    # Create a new perturbed typo dataset (accordingly the new language model)
+    util.create_typo_corpus(model_file=inputs["model"],
+                            words_ds=inputs["words"],
+                            typo_ds=outputs["typo"],
+                            seed=seed)
 
-with open(big_file, "r") as f:
-    big = f.read()
-    big_cleaned = util.clean_sentences_dataset(big)
 
-with open(big_file.replace(".txt", "_clean.txt"), mode="w") as outfile:
-    for r in big_cleaned:
-        outfile.write("%s\n" % r)
+def perturbed_outputs(name):
+    outputs = {}
 
-# Read LordOfTheRingsBook.json and extract a cleaned dataset
-with open(lotr_file) as json_data:
-    d = json.load(json_data)
-    lotr = [chapter["ChapterData"] for chapter in d]
-    lotr = "\n".join(lotr)
+    for level in noise_levels:
+        filename = perturbed_directory + "{}_clean_perturbed-{:.0%}.txt".format(name, level)
 
-    lotr_cleaned = util.clean_sentences_dataset(lotr)
+        outputs["perturbed-{:.0%}".format(level)] = filename
+        outputs["meta-{:.0%}".format(level)] = filename.replace(".txt", "-meta.csv")
 
-with open("../data/texts/lotr_clean.txt", mode="w") as outfile:
-    for r in lotr_cleaned:
-        outfile.write("%s\n" % r)
+    return outputs
 
-# Create a perturbed dataset
-if not os.path.exists("../data/texts/perturbed/"):
-    os.makedirs("../data/texts/perturbed/")
 
-# Create perturbed datasets for big
-with open("../data/texts/big_clean.txt", "r") as myfile:
-    cleaned = myfile.readlines()
+def stages():
+    result = []
 
-# Create the model for the perturbation
-hmm = HMM(1, max_edits=2, max_states=3)
-hmm.train(words_ds="../data/word_freq/big_language_model.txt",
-          sentences_ds="../data/texts/big_clean.txt",
-          typo_ds="../data/typo/clean/big_test.csv")
+    # Clean the raw typo datasets
+    typo_files = {}
 
-perturbed0a = open("../data/texts/perturbed/big_clean_perturbed-5%.txt", "w")
-perturbed1a = open("../data/texts/perturbed/big_clean_perturbed-10%.txt", "w")
-perturbed2a = open("../data/texts/perturbed/big_clean_perturbed-15%.txt", "w")
-perturbed3a = open("../data/texts/perturbed/big_clean_perturbed-20%.txt", "w")
+    for filename in sorted(os.listdir(directory)):
+        path = directory + filename
 
-util.perturb_file(perturbed0a, 0.05, cleaned, hmm)
-util.perturb_file(perturbed1a, 0.10, cleaned, hmm)
-util.perturb_file(perturbed2a, 0.15, cleaned, hmm)
-util.perturb_file(perturbed3a, 0.20, cleaned, hmm)
+        if filename.endswith(".txt"):
+            clean = clean_directory + filename.split(".txt")[0] + "_clean.csv"
 
-# Create perturbed datasets for lotr
-with open("../data/texts/lotr_clean.txt", "r") as myfile:
-    cleaned = myfile.readlines()
+            result.append(Stage("clean-" + filename, clean_typo_stage,
+                                inputs={"typo": path},
+                                outputs={"clean": clean}))
+            typo_files[filename] = clean
+        elif filename.endswith(".csv"):
+            typo_files[filename] = path
 
-# Create the model for the perturbation
-hmm = HMM(1, max_edits=2, max_states=3)
-hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
-          sentences_ds="../data/texts/lotr_clean.txt",
-          typo_ds="../data/typo/clean/lotr_test.csv")
+    result += [
+        Stage("split-big-typo", split_typo_stage,
+              inputs=typo_files,
+              outputs={"train": clean_directory + "big_train.csv",
+                       "test": clean_directory + "big_test.csv"},
+              params={"seed": 0}),
 
-perturbed0b = open("../data/texts/perturbed/lotr_clean_perturbed-5%.txt", "w")
-perturbed1b = open("../data/texts/perturbed/lotr_clean_perturbed-10%.txt", "w")
-perturbed2b = open("../data/texts/perturbed/lotr_clean_perturbed-15%.txt", "w")
-perturbed3b = open("../data/texts/perturbed/lotr_clean_perturbed-20%.txt", "w")
+        Stage("clean-big", clean_big_stage,
+              inputs={"raw": texts_directory + "big.txt"},
+              outputs={"clean": texts_directory + "big_clean.txt"}),
 
-util.perturb_file(perturbed0b, 0.05, cleaned, hmm)
-util.perturb_file(perturbed1b, 0.10, cleaned, hmm)
-util.perturb_file(perturbed2b, 0.15, cleaned, hmm)
-util.perturb_file(perturbed3b, 0.20, cleaned, hmm)
+        Stage("clean-lotr", clean_lotr_stage,
+              inputs={"raw": texts_directory + "LordOfTheRingsBook.json"},
+              outputs={"clean": texts_directory + "lotr_clean.txt"}),
 
-# Create lotr model language
-util.create_model_language()
+        Stage("lotr-language-model", lotr_language_model_stage,
+              inputs={"corpus": texts_directory + "lotr_clean.txt"},
+              outputs={"model": word_freq_directory + "lotr_language_model.txt",
+                       "binary": word_freq_directory + "lotr_language_model.npz"}),
 
-# Clean big model language
-frequency_alpha_gcide = pd.read_csv("../data/word_freq/frequency-alpha-gcide.txt", sep="\t", header=None)
+        Stage("big-language-model", big_language_model_stage,
+              inputs={"frequencies": word_freq_directory + "frequency-alpha-gcide.txt"},
+              outputs={"model": word_freq_directory + "big_language_model.txt"}),
 
-big_model_lang = pd.DataFrame()
-big_model_lang['word'] = [x.split()[1] for x in frequency_alpha_gcide[0].tolist()]
-big_model_lang['freq'] = frequency_alpha_gcide[2]
-big_model_lang.to_csv("../data/word_freq/big_language_model.txt", sep=',', index=False, header=None)
+        Stage("perturb-big", perturb_stage,
+              inputs={"words": word_freq_directory + "big_language_model.txt",
+                      "sentences": texts_directory + "big_clean.txt",
+                      "typo": clean_directory + "big_test.csv"},
+              outputs=perturbed_outputs("big"),
+              params={"seed": 0}),
+
+        Stage("lotr-typo-model", train_model_stage,
+              inputs={"words": word_freq_directory + "lotr_language_model.txt",
+                      "sentences": texts_directory + "lotr_clean.txt",
+                      "typo": clean_directory + "big_train.csv"},
+              outputs={"model": models_directory + "lotr_typo_model.pickle"}),
 
-# Create a new perturbed typo dataset (accordingly the new language model)
-typo_ds = open("../data/typo/clean/lotr_typo.csv", mode="w")
-util.create_typo_dataset(typo_ds)
+        Stage("lotr-typo", typo_corpus_stage,
+              inputs={"model": models_directory + "lotr_typo_model.pickle",
+                      "words": word_freq_directory + "lotr_language_model.txt"},
+              outputs={"typo": clean_directory + "lotr_typo.csv",
+                       "meta": clean_directory + "lotr_typo-meta.csv"},
+              params={"seed": 0}),
 
-# Split the typo dataset in train and test
-lotr_train, lotr_test = util.split_dataset(pd.read_csv("../data/typo/clean/lotr_typo.csv"))
+        Stage("split-lotr-typo", split_typo_stage,
+              inputs={"typo": clean_directory + "lotr_typo.csv"},
+              outputs={"train": clean_directory + "lotr_train.csv",
+                       "test": clean_directory + "lotr_test.csv"},
+              params={"seed": 0}),
+
+        Stage("perturb-lotr", perturb_stage,
+              inputs={"words": word_freq_directory + "lotr_language_model.txt",
+                      "sentences": texts_directory + "lotr_clean.txt",
+                      "typo": clean_directory + "lotr_test.csv"},
+              outputs=perturbed_outputs("lotr"),
+              params={"seed": 0}),
+    ]
+
+    return result
 
-lotr_train.to_csv(directory + "clean/lotr_train.csv", sep=',', header=None, index=False)
-lotr_test.to_csv(directory + "clean/lotr_test.csv", sep=',', header=None, index=False)
+
+if __name__ == "__main__":
+    # Only the stages whose inputs or parameters changed since the last run
+    # are executed, independent stages run in parallel
+    pipeline = Pipeline(stages(), cache_dir="../data/.cache/")
+    pipeline.run()
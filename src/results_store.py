@@ -0,0 +1,181 @@
+import fnmatch
+import shutil
+import zlib
+import json
+import time
+import os
+import pandas as pd
+import numpy as np
+
+
+def _narrowest(n):
+    # Narrowest signed type holding -1 to n
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+
+    return np.int64
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+class ResultsStore:
+
+    def __init__(self, directory):
+        # Tables of predictions and metrics of a run, one directory of .npy
+        # columns each, described by manifest.json. Columns of strings are
+        # dictionary encoded: the distinct strings of a table are stored once,
+        # sorted, as compressed UTF-8 bytes with their offsets, and its columns
+        # hold their codes in the narrowest type, so equal strings of different
+        # columns have equal codes. Columns are memory mapped when read.
+        self.directory = os.path.abspath(directory)
+        self.manifest_filename = os.path.join(self.directory, "manifest.json")
+
+        # Decoded strings of the tables read
+        self.dictionaries = {}
+
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"tables": {}}
+
+        return
+
+    def __contains__(self, name):
+        return name in self.manifest["tables"]
+
+    def __len__(self):
+        return len(self.manifest["tables"])
+
+    @property
+    def tables(self):
+        return sorted(self.manifest["tables"])
+
+    def _write_manifest(self):
+        filename = self.manifest_filename + ".tmp"
+
+        with open(filename, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+
+        os.replace(filename, self.manifest_filename)
+
+    def write(self, name, frame):
+        table_directory = os.path.join(self.directory, name)
+
+        if os.path.exists(table_directory):
+            shutil.rmtree(table_directory)
+        os.makedirs(table_directory)
+
+        encoded = [frame[column].dtype.kind not in "biuf" for column in frame.columns]
+
+        strings = sorted({str(value) for column, is_encoded in zip(frame.columns, encoded) if is_encoded
+                          for value in frame[column] if not _is_missing(value)})
+        index = {string: code for code, string in enumerate(strings)}
+        codes_dtype = _narrowest(len(strings))
+
+        encoded_strings = [string.encode("utf-8") for string in strings]
+        offsets = np.cumsum([0] + [len(string) for string in encoded_strings])
+
+        with open(os.path.join(table_directory, "strings.bin"), "wb") as f:
+            f.write(zlib.compress(b"".join(encoded_strings)))
+        np.save(os.path.join(table_directory, "offsets.npy"), offsets.astype(_narrowest(offsets[-1])))
+
+        columns = []
+        for k, (column, is_encoded) in enumerate(zip(frame.columns, encoded)):
+            if is_encoded:
+                values = np.array([-1 if _is_missing(value) else index[str(value)] for value in frame[column]],
+                                  dtype=codes_dtype)
+            else:
+                values = frame[column].to_numpy()
+
+            np.save(os.path.join(table_directory, "{}.npy".format(k)), values)
+            columns.append({"name": str(column), "dtype": values.dtype.str,
+                            "encoding": "dictionary" if is_encoded else "plain"})
+
+        self.dictionaries.pop(name, None)
+        self.manifest["tables"][name] = {"rows": len(frame), "strings": len(strings), "columns": columns,
+                                         "written": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self._write_manifest()
+
+    def strings(self, name):
+        # Dictionary of the string columns of table name, code order
+        if name not in self.dictionaries:
+            with open(os.path.join(self.directory, name, "strings.bin"), "rb") as f:
+                data = zlib.decompress(f.read())
+
+            offsets = np.load(os.path.join(self.directory, name, "offsets.npy")).tolist()
+
+            self.dictionaries[name] = [data[begin:end].decode("utf-8")
+                                       for begin, end in zip(offsets[:-1], offsets[1:])]
+
+        return self.dictionaries[name]
+
+    def column(self, name, column, decode=True):
+        # A column of table name, memory mapped. The codes of a string column
+        # are returned as they are without decode, e.g. to compare columns.
+        table = self.manifest["tables"][name]
+        k, description = next((k, c) for k, c in enumerate(table["columns"]) if c["name"] == column)
+
+        values = np.load(os.path.join(self.directory, name, "{}.npy".format(k)), mmap_mode="r")
+
+        if description["encoding"] == "plain" or not decode:
+            return values
+
+        # Missing values, coded -1, index the NaN after the strings
+        return np.array(self.strings(name) + [np.nan], dtype=object)[values]
+
+    def read(self, name, decode=True):
+        table = self.manifest["tables"][name]
+
+        return pd.DataFrame({c["name"]: self.column(name, c["name"], decode) for c in table["columns"]},
+                            columns=[c["name"] for c in table["columns"]])
+
+    def export_csv(self, name=None, filename=None):
+        # Write table name (all of them by default) to CSV, by default next to
+        # the store with the name of the table
+        names = self.tables if name is None else [name]
+
+        for table in names:
+            csv_filename = filename if filename is not None else os.path.join(self.directory, table + ".csv")
+            self.read(table).to_csv(csv_filename, sep=',', index=False)
+
+
+def write_frame(frame, filename):
+    # Write frame to a CSV file if filename ends with .csv, otherwise as table
+    # basename(filename) of the store in dirname(filename)
+    if filename.endswith(".csv"):
+        frame.to_csv(filename, sep=',', index=False)
+    else:
+        ResultsStore(os.path.dirname(filename) or ".").write(os.path.basename(filename), frame)
+
+
+def read_frame(filename):
+    # Read a frame written by write_frame(...)
+    if filename.endswith(".csv"):
+        return pd.read_csv(filename)
+    else:
+        return ResultsStore(os.path.dirname(filename) or ".").read(os.path.basename(filename))
+
+
+def collect(directories, pattern):
+    # Concatenate the tables matching pattern (e.g. "*-meta_typo_prediction-*")
+    # of the stores in directories, with the directory and the table of each
+    # row, to compare runs and experiments
+    frames = []
+
+    for directory in directories:
+        store = ResultsStore(directory)
+
+        for name in fnmatch.filter(store.tables, pattern):
+            frame = store.read(name)
+            frame.insert(0, "table", name)
+            frame.insert(0, "directory", directory)
+            frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class RandomBuffer:
+
+    def __init__(self, rng, block_size=4096):
+        # Draw uniform numbers from the generator in large blocks, instead of
+        # paying the cost of a numpy call for each one of them
+        self.rng = rng
+        self.block_size = block_size
+
+        self.block = []
+        self.pos = 0
+
+        return
+
+    def random(self):
+        if self.pos == len(self.block):
+            self.block = self.rng.random(self.block_size).tolist()
+            self.pos = 0
+
+        u = self.block[self.pos]
+        self.pos += 1
+
+        return u
+
+    def randint(self, n):
+        return int(self.random() * n)
+
+    def sample(self, n, k):
+        # k distinct integers in [0, n). k is usually very small compared to n,
+        # so rejection sampling is cheaper than a permutation.
+        result = []
+
+        while len(result) < k:
+            i = self.randint(n)
+
+            if i not in result:
+                result.append(i)
+
+        return result
+
+
+class AliasTable:
+
+    def __init__(self, symbols, weights):
+        # Walker's alias method (Vose's variant): O(n) construction, O(1)
+        # sampling with a single uniform number
+        self.symbols = list(symbols)
+
+        n = len(self.symbols)
+        weights = np.asarray(weights, dtype=np.float64)
+        scaled = (weights * n / weights.sum()).tolist()
+
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+
+        small = [i for i, w in enumerate(scaled) if w < 1]
+        large = [i for i, w in enumerate(scaled) if w >= 1]
+
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+
+            scaled[l] = scaled[l] + scaled[s] - 1
+
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+        # Leftovers are only due to rounding errors, they keep probability 1
+
+        return
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def sample(self, u):
+        # Map a uniform number u in [0, 1) to a symbol
+        u = u * len(self.symbols)
+        i = int(u)
+
+        if u - i < self.prob[i]:
+            return self.symbols[i]
+        else:
+            return self.symbols[self.alias[i]]
+
+    def sample_many(self, rng, size):
+        n = len(self.symbols)
+
+        u = rng.random(size) * n
+        i = u.astype(np.int64)
+
+        prob = np.asarray(self.prob)
+        alias = np.asarray(self.alias)
+
+        idx = np.where(u - i < prob[i], i, alias[i])
+
+        return [self.symbols[j] for j in idx]
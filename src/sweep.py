@@ -0,0 +1,147 @@
+from results_store import ResultsStore, read_frame, write_frame
+from hmm import HMM
+import evaluation as eval
+import pandas as pd
+import itertools
+import time
+import os
+
+
+class CandidateTable:
+
+    def __init__(self, hmm, max_edits, max_states):
+        # Candidates of each word searched once with the largest max_edits and
+        # max_states of a sweep. The top max_states of a smaller setting are
+        # the first ones of the larger, and the candidates at each distance are
+        # recorded along the way by HMM.candidate_levels(...). search_time is
+        # the total time spent searching, paid by the first setting to ask for
+        # each word.
+        self.hmm = hmm
+        self.max_edits = max_edits
+        self.max_states = max_states
+        self.levels = {}
+        self.search_time = 0
+
+        return
+
+    def get(self, word, max_edits, max_states):
+        key = self.hmm.reduce_lengthening(word.lower())
+
+        if key not in self.levels:
+            current = self.hmm.max_edits
+            self.hmm.max_edits = self.max_edits
+            start = time.time()
+
+            try:
+                self.levels[key] = self.hmm.candidate_levels(word, self.max_states)
+            finally:
+                self.hmm.max_edits = current
+                self.search_time += time.time() - start
+
+        return self.levels[key][max_edits - 1][:max_states]
+
+    def candidate_ids(self, max_edits, max_states):
+        # Replacement of HMM.candidate_ids(...) for a smaller setting
+        return lambda word, _=None: self.get(word, max_edits, max_states)
+
+    def candidates(self, max_edits, max_states):
+        # Replacement of HMM.candidates(...) for a smaller setting
+        return lambda word, _=None: self.hmm.candidate_words(word, self.get(word, max_edits, max_states))
+
+
+def derivable(hmm, grid):
+    # Whether the candidates of smaller settings are the first ones of the
+    # largest: not when the adaptive edit depth depends on how many of them
+    # are kept
+    return hmm.min_confidence is None and (hmm.min_candidates is None or
+                                           hmm.min_candidates <= min(grid["max_states"]))
+
+
+def train_model(words_ds, sentences_ds, typo_ds_train, alignments=None, **options):
+    print("Starting training…")
+    start = time.time()
+
+    hmm = HMM(1, max_edits=1, max_states=1, **options)
+    hmm.train(words_ds=words_ds,
+              sentences_ds=sentences_ds,
+              typo_ds=typo_ds_train,
+              alignments=alignments)
+
+    end = time.time()
+    train_time = end - start
+
+    print("Ended training in {:4.2f} seconds".format(train_time))
+
+    return hmm, train_time
+
+
+def record_search_time(meta_filename, table, search_time):
+    # Mark the test_time of meta_filename as derived from the shared
+    # candidate table, with the part of it spent searching the table since
+    # its search_time was search_time: the words searched for an earlier run
+    # cost nothing here
+    meta = read_frame(meta_filename)
+    meta["derived"] = table is not None
+    meta["shared_search_time"] = table.search_time - search_time if table is not None else 0
+    write_frame(meta, meta_filename)
+
+
+def run_experiment(directory, words_ds, sentences_ds, typo_ds_train, typo_ds_test, typo_tests, perturbed, grid,
+                   export_csv=False, **options):
+    # Evaluate every combination of the max_edits and max_states values of
+    # grid, writing the tables of each of them prefixed with its number to
+    # the ResultsStore of directory, and to CSV files too with export_csv.
+    # The model is trained once, since training doesn't depend on them.
+    # typo_tests and perturbed map the names used in the table names to the
+    # typo test sets and the perturbed texts. options are passed to HMM.
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    hmm, train_time = train_model(words_ds, sentences_ds, typo_ds_train, **options)
+
+    table = None
+    if derivable(hmm, grid):
+        table = CandidateTable(hmm, max(grid["max_edits"]), max(grid["max_states"]))
+
+    for n, (max_edits, max_states) in enumerate(itertools.product(grid["max_edits"], grid["max_states"]), start=1):
+        print("### Run {}: max_edits={}, max_states={}".format(n, max_edits, max_states))
+
+        hmm.max_edits = max_edits
+        hmm.max_states = max_states
+
+        candidates = table.candidates(max_edits, max_states) if table is not None else None
+        candidate_ids = table.candidate_ids(max_edits, max_states) if table is not None else None
+
+        model = {"max_edits": [hmm.max_edits], "max_states": [hmm.max_states], "order": [hmm.order],
+                 "state_len": [hmm.state_len], "error_model_p": [hmm.error_model['p']], 'train_time': [train_time],
+                 'language_ds': words_ds, 'sentence_ds': sentences_ds, 'typo_ds_train': typo_ds_train,
+                 'typo_ds_test': typo_ds_test, 'edit_distance': max_edits}
+        m = pd.DataFrame(model)
+        write_frame(m, "{}/{}-model".format(directory, n))
+
+        ## Typo
+        for name, typo_ds in typo_tests.items():
+            prediction_typo_filename = "{}/{}-typo_prediction-{}".format(directory, n, name)
+            meta_typo_filename = "{}/{}-meta_typo_prediction-{}".format(directory, n, name)
+
+            search_time = table.search_time if table is not None else 0
+            eval.prediction_hmm_candidate_test(typo_ds, hmm, prediction_typo_filename, meta_typo_filename,
+                                               candidates=candidates)
+            record_search_time(meta_typo_filename, table, search_time)
+            eval.evaluation_hmm_candidate_test(prediction_typo_filename, meta_typo_filename)
+
+        ## Sentence
+        for name, perturbed_ds in perturbed.items():
+            prediction_sentence_filename = "{}/{}-sentence_prediction-{}".format(directory, n, name)
+            meta_sentence_filename = "{}/{}-meta_sentence_prediction-{}".format(directory, n, name)
+
+            search_time = table.search_time if table is not None else 0
+            eval.prediction_hmm_sequence_test(sentences_ds, perturbed_ds, hmm, prediction_sentence_filename,
+                                              meta_sentence_filename, candidate_ids=candidate_ids)
+            record_search_time(meta_sentence_filename, table, search_time)
+            eval.evaluation_hmm_sequence_test(prediction_sentence_filename, meta_sentence_filename, perturbed_ds)
+
+    if export_csv:
+        ResultsStore(directory).export_csv()
+
+    return hmm
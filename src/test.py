@@ -1,7 +1,17 @@
 import matplotlib.pyplot as plt
+from collections import Counter
+from lexicon import Lexicon
 from markov import Markov
+from ngram_store import read_token_chunks
+from crossval import cross_validate
+from sweep import CandidateTable, derivable
 from hmm import HMM
+import asyncio
+import io
+import threading
 import time
+import csv
+import sys
 
 import pprint
 
@@ -10,11 +20,27 @@ pp = pprint.PrettyPrinter(indent=4)
 
 def markov_test():
     print("### Markov Test")
-    m = Markov(3, "word")
+    m = Markov(3, "word", seed=0)
     m.train("../data/texts/lotr_clean.txt")
 
     generated = m.generate(10)
     pp.pprint(generated)
+
+    generated = m.generate(10, starting_word="the ring")
+    pp.pprint(generated)
+
+    # Characters instead of words
+    m = Markov(5, "ngram", seed=0)
+    m.train("../data/texts/lotr_clean.txt")
+
+    generated = m.generate(100, starting_word="frodo")
+    pp.pprint(generated)
+
+    # Tokens are generated lazily, without building the whole text
+    start = time.time()
+    n = sum(1 for _ in m.stream(1000000))
+    end = time.time()
+    pp.pprint("Generated {} tokens in {:6.2f} seconds".format(n, end - start))
     print("\n")
 
 
@@ -144,6 +170,142 @@ def hmm_predict_sequence_test():
     pp.pprint("Corrected: " + correct)
 
 
+def hmm_k_best_test():
+    print("### HMM K-Best Test")
+
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    sentence = "wpen mr bilbo bagginx of bag end announcwd that he"
+    pp.pprint("Sentence: " + sentence)
+
+    # The alternatives are enumerated from the trellis built for the best one
+    for correct, probability in hmm.predict_sequences(sentence, 10):
+        pp.pprint("{:.3e} {}".format(probability, correct))
+
+    print("\n")
+
+
+def hmm_stream_test():
+    print("### HMM Stream Test")
+
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    # The whole text as a single sequence, read and corrected word by word
+    def words(file):
+        with open(file, "r") as f:
+            for line in f:
+                yield from line.split()
+
+    start = time.time()
+
+    for n, word in enumerate(hmm.stream_sequence(words("../data/texts/perturbed/lotr_clean_perturbed-10%.txt"), lag=8)):
+        if n < 50:
+            print(word, end=" ")
+
+    end = time.time()
+    print()
+    pp.pprint("Corrected {} words in {:6.2f} seconds".format(n + 1, end - start))
+    print("\n")
+
+
+def hmm_async_test():
+    print("### HMM Async Test")
+
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    sentences = ["wpen mr bilbo bagginx of bag end announcwd that he",
+                 "now beclml a local legend and it wos popultrly believed",
+                 "was too much of f goof thing it seemed unfair",
+                 "so fap trouble had not come and as mr baggins"]
+
+    async def main():
+        pp.pprint(await hmm.candidates_async("bagginx"))
+
+        for correct in await hmm.predict_sequence_batch_async(sentences, timeout=60):
+            pp.pprint("Corrected: " + correct)
+
+        try:
+            await hmm.predict_sequence_async(sentences[0], timeout=0.01)
+        except asyncio.TimeoutError:
+            pp.pprint("Timed out")
+
+    asyncio.run(main())
+
+    # The tasks of a timed out call finish in the pool after its event loop
+    # is closed: the pool must still answer the calls that follow
+    async def timed_out():
+        try:
+            await hmm.candidates_async("qwertyzxcvbnmasdfghjkl", timeout=0.001)
+        except asyncio.TimeoutError:
+            pass
+
+    for typo, correct in [("hobit", "hobbit"), ("bagins", "baggins"), ("gandalg", "gandalf")]:
+        asyncio.run(timed_out())
+
+        assert [c for c, _ in hmm.candidates(typo)][:1] == [correct]
+
+    pp.pprint("Sync calls answered after async timeouts")
+    print("\n")
+
+
+def hmm_concurrency_test():
+    print("### HMM Concurrency Test")
+
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    with open("../data/texts/perturbed/lotr_clean_perturbed-10%.txt", "r") as f:
+        sentences = [next(f).strip() for _ in range(10)]
+
+    expected = [hmm.predict_sequence(sentence) for sentence in sentences]
+
+    # Many threads decoding the same sentences on the same model, in
+    # different orders
+    nthreads = 16
+    errors = []
+
+    def hammer(offset):
+        for i in range(len(sentences)):
+            k = (i + offset) % len(sentences)
+
+            if hmm.predict_sequence(sentences[k]) != expected[k]:
+                errors.append(k)
+
+    # With the shared candidate cache, and without it so that every thread
+    # goes through the pool
+    for cache in (hmm.cache, None):
+        hmm.cache = cache
+        errors.clear()
+
+        threads = [threading.Thread(target=hammer, args=(offset,)) for offset in range(nthreads)]
+
+        start = time.time()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        end = time.time()
+
+        pp.pprint("Cache {}: {} threads, {} sequences, {} mismatches in {:6.2f} seconds".format(
+            "on" if cache is not None else "off", nthreads, nthreads * len(sentences), len(errors), end - start))
+
+    print("\n")
+
+
 def gen_test():
     print("### HMM Candidates Test")
 
@@ -161,9 +323,275 @@ def gen_test():
     pp.pprint(x)
 
 
+def hmm_metrics_test():
+    print("### HMM Metrics Test")
+
+    hmm = HMM(1, max_edits=2, max_states=5)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    hmm.enable_metrics()
+    hmm.predict_sequence("wpen mr bilbo bagginx of bag end announcwd that he")
+    pp.pprint(hmm.metrics_snapshot())
+    print("\n")
+
+
+def hmm_escalation_test():
+    print("### HMM Adaptive Edit Depth Test")
+
+    # Top-1 and top-5 recall with and without the adaptive edit depth, on the
+    # typo test sets (the table of the README)
+    hmm = HMM(1, max_edits=2, max_states=5)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    hmm.enable_metrics()
+
+    for test_set in ["spell-testset1", "spell-testset2"]:
+        with open("../data/typo/clean/{}_clean.csv".format(test_set), "r") as f:
+            obs = [row for row in csv.reader(f)]
+
+        baseline = None
+
+        for min_candidates, min_confidence, frequent_prob in [(None, None, None), (1, 0.5, None), (1, 0.9, 1e-4),
+                                                              (3, 0.5, 1e-4)]:
+            hmm.min_candidates = min_candidates
+            hmm.min_confidence = min_confidence
+            hmm.frequent_prob = frequent_prob
+            hmm.metrics.reset()
+
+            # Candidates cached by the previous test set aren't searched again
+            if hmm.cache is not None:
+                hmm.cache.clear()
+
+            top1 = top5 = 0
+            start = time.time()
+
+            for typo, correct in obs:
+                candidates = [c for c, _ in hmm.candidates(typo)]
+                top1 += candidates[:1] == [correct]
+                top5 += correct in candidates
+
+            end = time.time()
+
+            if baseline is None:
+                baseline = end - start
+
+            counters = hmm.metrics_snapshot()["counters"]
+            escalation_rate = counters.get("escalations", 0) / max(counters.get("escalation_checks", 0), 1)
+
+            pp.pprint("{} min_candidates={} min_confidence={} frequent_prob={}".format(
+                test_set, min_candidates, min_confidence, frequent_prob))
+            pp.pprint("Top-1: {:4.2f} %, top-5: {:4.2f} %, escalation rate: {:4.2f} %, time: {:6.2f} seconds "
+                      "({:4.2f}x)".format(top1 / len(obs) * 100, top5 / len(obs) * 100, escalation_rate * 100,
+                                          end - start, (end - start) / baseline))
+
+    print("\n")
+
+
+def hmm_real_word_typo_test():
+    print("### HMM Real-Word Typo Test")
+
+    # Typos of the training set that are themselves known words (e.g. "she"
+    # typed for "shelf") are answered from the typo index, which must keep
+    # the typed word among their candidates with the escalation thresholds
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    real_words = sorted(typo for typo in hmm.typo_index if hmm.language_model.index(typo) != -1)
+    exhaustive = {typo: [c for c, _ in hmm.candidates(typo)] for typo in real_words}
+
+    for min_candidates, min_confidence, frequent_prob in [(1, None, None), (None, 0.5, None), (None, None, 1e-4)]:
+        hmm.min_candidates = min_candidates
+        hmm.min_confidence = min_confidence
+        hmm.frequent_prob = frequent_prob
+
+        assert [c for c, _ in hmm.candidates("she")][:1] == ["she"]
+        assert [c for c, _ in hmm.candidates("by")][:1] == ["by"]
+        assert hmm.predict_sequence("she said i would go by the river") == "she said i would go by the river"
+
+        dropped = [typo for typo in real_words
+                   if typo in exhaustive[typo] and typo not in [c for c, _ in hmm.candidates(typo)]]
+        assert not dropped, dropped
+
+    pp.pprint("Real-word typos in the typo index: {}, none dropped".format(len(real_words)))
+    print("\n")
+
+
+def hmm_typo_index_test():
+    print("### HMM Typo Index Test")
+
+    # Without escalation thresholds the observed misspellings are answered
+    # from the typo index alone, without searching
+    hmm = HMM(1, max_edits=2, max_states=5)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    typos = sorted(hmm.typo_index)[:500]
+
+    hmm.enable_metrics()
+    start = time.time()
+
+    for typo in typos:
+        assert hmm.candidate_ids(typo) == hmm.typo_index[typo][:hmm.max_states], typo
+
+    end = time.time()
+
+    counters = hmm.metrics_snapshot()["counters"]
+    assert counters.get("typo_index_hits", 0) == len(typos)
+    assert counters.get("pool_round_trips", 0) == 0 and counters.get("neighbour_hits", 0) == 0
+
+    pp.pprint("{} typos answered from the typo index in {:6.2f} seconds".format(len(typos), end - start))
+    print("\n")
+
+
+def hmm_ranking_test():
+    print("### HMM Ranking Test")
+
+    # The candidates are the top max_states of all the known words within
+    # max_edits, each scored with the number of them, for any max_states
+    hmm = HMM(1, max_edits=2, max_states=5)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    words = ["the", "rich", "ring", "a", "when", "with", "wonder", "hobit", "bagginx", "gandalg"]
+
+    for word in words:
+        if word in hmm.typo_index:
+            continue
+
+        known = hmm.known_ids(hmm.edits(word, hmm.max_edits))
+        ranking = sorted(((state, hmm.compute_probability(typed=word, intended=intended, n_candidates=len(known)))
+                          for intended, state in known.items()), key=lambda c: (-c[1], c[0]))
+
+        for max_states in (1, 3, 5):
+            assert hmm.candidate_ids(word, max_states) == ranking[:max_states], (word, max_states)
+
+    pp.pprint({word: [c for c, _ in hmm.candidates(word)] for word in words})
+    print("\n")
+
+
+def sweep_derivation_test():
+    print("### Sweep Derivation Test")
+
+    # The candidates of the smaller settings of a sweep, derived from a single
+    # search with the largest, are the ones of a direct search
+    hmm = HMM(1, max_edits=2, max_states=5)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv")
+
+    words = [w for w, _ in sorted(hmm.language_model.items(), key=lambda c: c[1], reverse=True)[:300]]
+    with open("../data/typo/clean/spell-testset1_clean.csv", "r") as f:
+        words += [row[0] for row in csv.reader(f)][:100]
+
+    grid = {"max_edits": [1, 2], "max_states": [1, 3, 5]}
+
+    for min_candidates, frequent_prob in [(None, None), (1, 1e-4)]:
+        hmm.min_candidates = min_candidates
+        hmm.frequent_prob = frequent_prob
+        assert derivable(hmm, grid)
+
+        table = CandidateTable(hmm, max(grid["max_edits"]), max(grid["max_states"]))
+
+        for max_edits in grid["max_edits"]:
+            hmm.max_edits = max_edits
+
+            for max_states in grid["max_states"]:
+                mismatches = [word for word in words
+                              if table.get(word, max_edits, max_states) != hmm.candidate_ids(word, max_states)]
+                assert not mismatches, (max_edits, max_states, mismatches)
+
+        hmm.max_edits = max(grid["max_edits"])
+
+    pp.pprint("Derived candidates of {} words match the direct ones".format(len(words)))
+    print("\n")
+
+
+def lexicon_memory_test():
+    print("### Lexicon Memory Test")
+
+    with open("../data/word_freq/big_language_model.txt", "r") as f:
+        items = [(row[0], float(row[1])) for row in csv.reader(f)]
+
+    counter = Counter(dict(items))
+    counter_size = sys.getsizeof(counter) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in counter.items())
+
+    lexicon = Lexicon.from_items(items)
+
+    pp.pprint("Words: " + str(len(lexicon)))
+    pp.pprint("Counter: {:.2f} MB".format(counter_size / 2**20))
+    pp.pprint("Lexicon: {:.2f} MB".format(lexicon.nbytes / 2**20))
+    print("\n")
+
+
+def ngram_store_test():
+    print("### N-gram Store Test")
+
+    # Transition counts written to disk and memory mapped, instead of held in
+    # the graph of the model
+    hmm = HMM(1, max_edits=2, max_states=3)
+    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
+              sentences_ds="../data/texts/lotr_clean.txt",
+              typo_ds="../data/typo/clean/lotr_train.csv",
+              ngram_store="../data/ngrams/lotr_hmm")
+
+    pp.pprint("Histories: {}, n-grams: {}, {:.2f} MB".format(len(hmm.ngram_store), len(hmm.ngram_store.next),
+                                                           hmm.ngram_store.nbytes / 2**20))
+    pp.pprint(hmm.predict_sequence("wpen mr bilbo bagginx of bag end announcwd that he"))
+
+    m = Markov(3, "word", seed=0)
+    m.train("../data/texts/lotr_clean.txt", ngram_store="../data/ngrams/lotr_markov")
+
+    pp.pprint(m.generate(10, starting_word="the ring"))
+
+    # Blocks are cut on any whitespace: text separated only by tabs is read
+    # in blocks of about chunk_size too
+    text = "\t".join("word{}".format(i) for i in range(10000))
+    chunks = list(read_token_chunks(io.StringIO(text), 100))
+
+    assert "".join(chunks) == text and max(len(chunk) for chunk in chunks) < 200
+    print("\n")
+
+
+def cross_validation_test():
+    print("### Cross Validation Test")
+
+    # The typo pairs are aligned on the first run only, later runs read them
+    # from alignments_file
+    hmm, results = cross_validate("../results/cross_validation",
+                                  words_ds="../data/word_freq/lotr_language_model.txt",
+                                  sentences_ds="../data/texts/lotr_clean.txt",
+                                  typo_ds="../data/typo/clean/lotr_train.csv",
+                                  k=5, seed=0, max_edits=2, max_states=5,
+                                  alignments_file="../results/cross_validation/alignments.pkl")
+
+    pp.pprint(results)
+    print("\n")
+
+
 # markov_test()
 
 hmm_candidate_test()
 # hmm_build_trellis_test()
 # hmm_predict_sequence_test()
+# hmm_k_best_test()
+# hmm_stream_test()
+# hmm_async_test()
+# hmm_concurrency_test()
 # gen_test()
+# hmm_metrics_test()
+# hmm_escalation_test()
+# hmm_real_word_typo_test()
+# hmm_typo_index_test()
+# hmm_ranking_test()
+# sweep_derivation_test()
+# lexicon_memory_test()
+# ngram_store_test()
+# cross_validation_test()
@@ -10,6 +10,9 @@ hmm.train(words_ds=os.path.join(data_dir, "word_freq", "lotr_language_model.txt"
           sentences_ds=os.path.join(data_dir, "texts", "lotr_clean.txt"),
           typo_ds=os.path.join(data_dir, "typo", "clean", "lotr_train.csv"))
 
+# Known words are corrected with a lookup in the neighbour index
+hmm.build_neighbour_index()
+
 hmm_file = os.path.join(output_dir, "hmm.pickle")
 hmm.save(hmm_file)
 
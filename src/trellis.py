@@ -0,0 +1,225 @@
+import heapq
+
+
+class Column:
+    __slots__ = ["typed", "states", "probs", "back", "edges"]
+
+    def __init__(self, typed, states, probs, back, edges=None):
+        # One time step of the trellis: the typed word, the ids of the candidate
+        # states, the probability of the best path ending in each state and the
+        # index of its predecessor in the previous column. edges lists for each
+        # state its (predecessor index, transition times emission probability)
+        # pairs, best path first, for the k-best paths.
+        self.typed = typed
+        self.states = states
+        self.probs = probs
+        self.back = back
+        self.edges = edges
+
+
+class Trellis:
+
+    def __init__(self):
+        self.columns = []
+
+        return
+
+    def __len__(self):
+        return len(self.columns)
+
+    def append(self, column):
+        self.columns.append(column)
+
+    def best_path(self):
+        # Indices of the states on the most likely path, one per column
+        last = self.columns[-1]
+
+        # Finding global maximum probability between last states (Viterbi)
+        k = max(range(len(last.probs)), key=last.probs.__getitem__)
+
+        return self.path_to(len(self.columns) - 1, k)
+
+    def path_to(self, t, k):
+        # Indices of the states on the best path ending in state k of column t
+        path = [k]
+        for column in reversed(self.columns[1:t + 1]):
+            k = column.back[k]
+            path.append(k)
+
+        path.reverse()
+
+        return path
+
+    def rescale(self):
+        # Divide the probabilities of the last column by their maximum. The
+        # best paths don't change, but the probabilities of long sequences
+        # don't underflow.
+        last = self.columns[-1]
+        top = max(last.probs)
+
+        if top > 0:
+            last.probs = [p / top for p in last.probs]
+
+    def coalesced(self):
+        # Latest (column, state index) that all the live paths ending in the
+        # last column go through, None if they don't meet
+        last = self.columns[-1]
+        live = {k for k, p in enumerate(last.probs) if p > 0} or set(range(len(last.states)))
+
+        for t in range(len(self.columns) - 1, -1, -1):
+            if len(live) == 1:
+                return t, live.pop()
+
+            if t > 0:
+                live = {self.columns[t].back[k] for k in live}
+
+        return None
+
+    def commit(self, t, k):
+        # Fix state k of column t: the columns before it are dropped, column t
+        # is left with state k only and the following columns are decoded
+        # again from it with their edges
+        column = self.columns[t]
+        self.columns = self.columns[t:]
+        self.columns[0] = Column(column.typed, [column.states[k]], [column.probs[k]], [-1])
+
+        for u in range(1, len(self.columns)):
+            leaves = self.columns[u - 1]
+            column = self.columns[u]
+
+            if u == 1:
+                column.edges = [[(0, w) for j, w in weights if j == k] for weights in column.edges]
+
+            probs = []
+            back = []
+            edges = []
+
+            for weights in column.edges:
+                # Best leaf, ties in leaf order as when the column was built
+                weights = sorted(weights)
+                best_leaf = 0
+                best_p = 0
+
+                for j, w in weights:
+                    p = w * leaves.probs[j]
+
+                    if p > best_p:
+                        best_leaf = j
+                        best_p = p
+
+                probs.append(best_p)
+                back.append(best_leaf)
+                edges.append(sorted(weights, key=lambda e: e[1] * leaves.probs[e[0]], reverse=True))
+
+            column.probs = probs
+            column.back = back
+            column.edges = edges
+
+    def k_best_paths(self):
+        # Lazily yield the (path, probability) pairs of all the paths in order
+        # of decreasing probability, starting with best_path(). The j-th best
+        # paths ending in each state are only computed when needed, following
+        # the lazy k-best algorithm of Huang and Chiang (2005).
+        last = len(self.columns) - 1
+
+        # For each column and state, the best paths found so far ending there
+        # as (probability, predecessor index, rank of the path to it, edge
+        # index) and the heap of the next candidates
+        found = [[None] * len(column.states) for column in self.columns]
+        heaps = [[None] * len(column.states) for column in self.columns]
+
+        def kth(t, s, j):
+            # j-th best path ending in state s of column t, None if there are
+            # fewer paths
+            column = self.columns[t]
+
+            if found[t][s] is None:
+                if t == 0:
+                    found[t][s] = [(column.probs[s], -1, -1, -1)]
+                    heaps[t][s] = []
+                else:
+                    found[t][s] = []
+                    heaps[t][s] = [(-w * kth(t - 1, k, 0)[0], e, 0) for e, (k, w) in enumerate(column.edges[s])]
+                    heapq.heapify(heaps[t][s])
+
+            paths = found[t][s]
+            heap = heaps[t][s]
+
+            while len(paths) <= j:
+                if paths and t > 0:
+                    # The next path through the same edge as the last one
+                    _, _, rank, e = paths[-1]
+                    k, w = column.edges[s][e]
+                    previous = kth(t - 1, k, rank + 1)
+
+                    if previous is not None:
+                        heapq.heappush(heap, (-w * previous[0], e, rank + 1))
+
+                if not heap:
+                    return None
+
+                p, e, rank = heapq.heappop(heap)
+                paths.append((-p, column.edges[s][e][0], rank, e))
+
+            return paths[j]
+
+        if last < 0:
+            return
+
+        # Paths of the last column, ordered like in best_path()
+        heap = [(-kth(last, s, 0)[0], s, 0) for s in range(len(self.columns[last].states))]
+        heapq.heapify(heap)
+
+        while heap:
+            p, s, j = heapq.heappop(heap)
+
+            path = [s]
+            k, rank = s, j
+            for t in range(last, 0, -1):
+                _, k, rank, _ = kth(t, k, rank)
+                path.append(k)
+
+            path.reverse()
+
+            yield path, -p
+
+            following = kth(last, s, j + 1)
+            if following is not None:
+                heapq.heappush(heap, (-following[0], s, j + 1))
+
+    def node_ids(self, path):
+        # Node ids of a path, numbering the nodes column by column after the
+        # root (which is node 0)
+        ids = []
+        offset = 1
+
+        for column, k in zip(self.columns, path):
+            ids.append(offset + k)
+            offset += len(column.states)
+
+        return ids
+
+    def to_networkx(self, name):
+        # Graph with one node per state, connected to its best predecessor.
+        # name maps a column and a state index to the label of the node.
+        import networkx as nx
+
+        G = nx.DiGraph()
+        G.add_node(0, name="•")
+
+        offset = 1
+        prev_offset = 0
+
+        for depth, column in enumerate(self.columns, start=1):
+            for k, p in enumerate(column.probs):
+                G.add_node(offset + k, name=name(column, k), depth=depth)
+
+                if depth == 1:
+                    G.add_edge(0, offset + k, weight=p)
+                else:
+                    G.add_edge(prev_offset + column.back[k], offset + k, weight=p)
+
+            prev_offset = offset
+            offset += len(column.states)
+
+        return G
@@ -1,13 +1,23 @@
-from collections import Counter, defaultdict
+from collections import Counter, deque
+from sampling import AliasTable, RandomBuffer
 from hmm import HMM
+from ngram_store import read_token_chunks
+import multiprocessing
+import itertools
+import tempfile
+import lexicon
+import heapq
 import pandas as pd
 import numpy as np
-import random
+import shutil
 import string
 import time
 import csv
+import os
 import re
 
+non_alphanumeric = re.compile(r"[^a-zA-Z0-9]+")
+
 
 def read_dataset(dataset):
     with open(dataset, "r") as f:
@@ -35,15 +45,17 @@ def clean_dataset(directory, dataset):
                 new_f.write("\n")
 
 
-def split_dataset(combined_csv):
+def split_dataset(combined_csv, seed=None):
+    rng = np.random.default_rng(seed)
+
     # lowercase
     df = combined_csv.apply(lambda x: x.astype(str).str.lower())
 
     # shuffle data frame
-    df['split'] = np.random.randn(df.shape[0], 1)
+    df['split'] = rng.standard_normal((df.shape[0], 1))
 
     df['is_duplicate'] = df.duplicated()  # no duplicated rows
-    msk = np.random.rand(len(df)) <= 0.8
+    msk = rng.random(len(df)) <= 0.8
 
     train = df[msk].drop(['split', 'is_duplicate'], axis=1)
     test = df[~msk].drop(['split', 'is_duplicate'], axis=1)
@@ -51,27 +63,88 @@ def split_dataset(combined_csv):
     return train, test
 
 
-def clean_sentences_dataset(ds):
-    ds = ds.replace("Mr.", "Mr").replace("Mrs.", "Mrs")
-    ds = ds.split(".")
+def clean_sentences(lines):
     splitted = list()
 
-    for line in ds:
-        if len(line.split()) < 5:
-            continue
-        elif len(line.split()) > 10:
-            line = split_list(line.split(), 10)
+    for line in lines:
+        words = line.split()
 
-            splitted.extend(line)
+        if len(words) < 5:
+            continue
+        elif len(words) > 10:
+            splitted.extend(split_list(words, 10))
         else:
             splitted.append(line)
 
     cleaned = [r.strip().lower().replace("'", '') for r in splitted]
-    cleaned = [re.sub(r"[^a-zA-Z0-9]+", ' ', r) for r in cleaned]
+    cleaned = [non_alphanumeric.sub(' ', r) for r in cleaned]
 
     return cleaned
 
 
+def clean_sentences_dataset(ds):
+    ds = ds.replace("Mr.", "Mr").replace("Mrs.", "Mrs")
+
+    return clean_sentences(ds.split("."))
+
+
+def _sentence_boundary(text):
+    # Position of the last full stop of text which can't be removed by the
+    # "Mr." and "Mrs." replacements, or -1
+    end = text.rfind(".")
+
+    while end != -1 and text[:end].endswith(("Mr", "Mrs", "Mr.s")):
+        end = text.rfind(".", 0, end)
+
+    return end
+
+
+def read_sentence_chunks(f, chunk_size):
+    # Read f in blocks of about chunk_size characters, cut on sentence
+    # boundaries. Cleaning the chunks one by one gives the same result as
+    # cleaning the whole text at once.
+    carry = ""
+
+    while True:
+        block = f.read(chunk_size)
+
+        if not block:
+            break
+
+        text = carry + block
+        end = _sentence_boundary(text)
+
+        if end == -1:
+            carry = text
+        else:
+            yield text[:end + 1]
+            carry = text[end + 1:]
+
+    if carry:
+        yield carry
+
+
+def _clean_sentences_chunk(text):
+    return clean_sentences_dataset(text)
+
+
+def clean_sentences_file(infile, outfile, chunk_size=1 << 22, nprocesses=None):
+    # Streaming version of clean_sentences_dataset: infile is read in chunks,
+    # cleaned in parallel and written to outfile as soon as possible
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+
+    with multiprocessing.Pool(nprocesses) as pool, \
+            open(infile, "r") as f, \
+            open(outfile, "w") as out:
+
+        chunks = read_sentence_chunks(f, chunk_size)
+
+        for cleaned in bounded_imap(pool, _clean_sentences_chunk, chunks, 2 * nprocesses):
+            for r in cleaned:
+                out.write("%s\n" % r)
+
+
 def extract_model_edit_probabilities(hmm):
     # probability that a word has an edit
     p = hmm.error_model["p"]
@@ -87,122 +160,246 @@ def extract_model_edit_probabilities(hmm):
     return p, edit_prob
 
 
-def perturb_word(edit_prob, indices, word, x):
-    def substitute(word):
-        l = list(word)
-        if not l[indices[j]] in edit_prob[3]:
-            l[indices[j]] = random.choice(string.ascii_letters).lower().replace(l[indices[j]], "")
-        else:
-            l[indices[j]] = np.random.choice(list(edit_prob[3][l[indices[j]]].keys() - l[indices[j]]))
-        return "".join(l)
+class EditSampler:
 
-    for j in range(x):
-        r = np.random.randint(4)
+    def __init__(self, edit_prob, random):
+        # Per-character sampling tables for the letters introduced by
+        # insertions and substitutions, weighted by the error model
+        self.insert_tables = self._char_tables(edit_prob[1])
+        self.substitute_tables = self._char_tables(edit_prob[3])
+        self.random = random
 
-        # swap if you have to do only one edit
-        if r == 0 and x == 1:
-            # if the letter to switch is the last one, switch with the previous one
-            if len(indices) <= j + 1:
-                word = word[0:indices[j] - 1] + word[indices[j]] + word[indices[j] - 1] + word[indices[j] + 1:]
-            else:
-                word = word[0:indices[j]] + word[indices[j] + 1] + word[indices[j]] + word[indices[j] + 2:]
+        self.fallback_tables = {}
 
-        # insert a letter in a random position (after idx)
-        elif r == 1:
-            if not word[indices[j]] in edit_prob[1]:
-                new_letter = random.choice(string.ascii_letters).lower().replace(word[indices[j]], "")
-            else:
-                new_letter = np.random.choice(list(edit_prob[1][word[indices[j]]].keys() - word[indices[j]]))
-            word = word[0:indices[j]] + new_letter + word[indices[j] + 1:]
-
-        # delete a letter
-        elif r == 2:
-            if len(word) == 1:
-                # if the word is 1 char, don't delete the word but substitute it with another one
-                word = substitute(word)
+        return
+
+    @staticmethod
+    def _char_tables(model):
+        tables = {}
+
+        for char, probs in model.items():
+            symbols = [c for c in probs.keys() if c != char]
+
+            if symbols:
+                tables[char] = AliasTable(symbols, [probs[c] for c in symbols])
+
+        return tables
+
+    def _fallback_table(self, char):
+        # Uniform distribution over the letters different from char, used for
+        # characters never observed in the error model
+        if char not in self.fallback_tables:
+            symbols = [c for c in string.ascii_lowercase if c != char]
+            self.fallback_tables[char] = AliasTable(symbols, [1] * len(symbols))
+
+        return self.fallback_tables[char]
+
+    def _letter(self, tables, char):
+        table = tables.get(char)
+
+        if table is None:
+            table = self._fallback_table(char)
+
+        return table.sample(self.random.random())
+
+    def perturb_word(self, word, indices):
+        # Apply one edit at each of the indices, which must be sorted in
+        # decreasing order
+        x = len(indices)
+
+        for idx in indices:
+            r = self.random.randint(4)
+
+            # swap if you have to do only one edit
+            if r == 0 and x == 1 and len(word) > 1:
+                # if the letter to switch is the first one, switch with the next one
+                if idx == 0:
+                    idx = 1
+
+                word = word[0:idx - 1] + word[idx] + word[idx - 1] + word[idx + 1:]
+
+            # insert a letter in a random position (after idx)
+            elif r == 1:
+                new_letter = self._letter(self.insert_tables, word[idx])
+                word = word[0:idx] + new_letter + word[idx + 1:]
+
+            # delete a letter, if the word is 1 char substitute it instead
+            elif r == 2 and len(word) > 1:
+                word = word[0:idx] + word[idx + 1:]
+
+            # substitute a letter
             else:
-                word = word[0:indices[j]] + word[indices[j] + 1:]
+                new_letter = self._letter(self.substitute_tables, word[idx])
+                word = word[0:idx] + new_letter + word[idx + 1:]
 
-        # substitute a letter
-        else:
-            word = substitute(word)
-    return word
+        return word
 
 
-def perturb_file(perturbed, rumor_percentage, cleaned, hmm):
+def perturb_files(perturbed, rumor_percentages, cleaned, hmm, seed=None):
+    # Generate one perturbed copy of cleaned for each percentage in a single
+    # pass over the input. perturbed is a list of files, one per percentage.
     p, edit_prob = extract_model_edit_probabilities(hmm)
 
-    p = p * rumor_percentage  # introduce a certain percentage of error (10-15-20%)
+    rng = np.random.default_rng(seed)
+    random = RandomBuffer(rng)
+    sampler = EditSampler(edit_prob, random)
+
+    # introduce a certain percentage of error (10-15-20%)
+    p = p * np.asarray(rumor_percentages)
+    levels = len(rumor_percentages)
 
-    print("\n Starting perturb {} …".format(perturbed.name))
+    print("\n Starting perturb {} …".format(", ".join(f.name for f in perturbed)))
     start = time.time()
 
-    typo_counter = 0
+    typo_counter = [0] * levels
+    perturbed_word = [0] * levels
     word_counter = 0
-    perturbed_word = 0
 
     for line in cleaned:
-        line = line.replace("\n", "")
         line_words = line.split()
 
-        for i, word in enumerate(line_words):
-            n = len(word)
-            # number of errors to introduce in the word
-            x = np.random.binomial(n, p)  # x ~ Bin(p, n)
+        if not line_words:
+            for f in perturbed:
+                f.write("\n")
+            continue
+
+        # number of errors to introduce in each word, for all the levels at once
+        # x ~ Bin(p, n)
+        lengths = np.fromiter((len(w) for w in line_words), dtype=np.int64, count=len(line_words))
+        x = rng.binomial(lengths[:, np.newaxis], p[np.newaxis, :]).tolist()
+
+        for level, f in enumerate(perturbed):
+            perturbed_words = list(line_words)
+
+            for i, word in enumerate(line_words):
+                n_errors = x[i][level]
+
+                if n_errors == 0:
+                    continue
 
-            # choose two letter to change
-            indices = np.random.choice(n, x, replace=False)
-            indices = -np.sort(-indices)
+                # choose the letters to change, right to left so that the
+                # indices stay valid while editing
+                indices = sorted(random.sample(len(word), n_errors), reverse=True)
 
-            word = perturb_word(edit_prob, indices, word, x)
+                perturbed_words[i] = sampler.perturb_word(word, indices)
 
-            line_words[i] = word
+                perturbed_word[level] += 1
+                typo_counter[level] += n_errors
 
-            if x != 0:
-                perturbed_word += 1
-            typo_counter += x
-            word_counter += 1
+            f.write(" ".join(perturbed_words) + "\n")
 
-        line = " ".join(line_words)
-        perturbed.write(line + '\n')
+        word_counter += len(line_words)
 
     end = time.time()
     perturb_time = end - start
 
-    perturbed.close()
-
     print("Ended perturbation in {:6.2f} seconds \n".format(perturb_time))
 
-    typo_per_word = typo_counter / word_counter
-    perturbed_word_percentage = perturbed_word / word_counter
+    for level, f in enumerate(perturbed):
+        f.close()
 
-    m = {'file': [perturbed.name], 'typo_percentage': [typo_per_word],
-         'perturbed_word_percentage': [perturbed_word_percentage], 'total_typo': [typo_counter],
-         'total_word': [word_counter], 'perturbed_word': perturbed_word}
-    meta = pd.DataFrame(m)
-    meta.to_csv(perturbed.name.replace('.txt', '-meta.csv'), sep=',', index=False)
+        typo_per_word = typo_counter[level] / word_counter
+        perturbed_word_percentage = perturbed_word[level] / word_counter
+
+        m = {'file': [f.name], 'typo_percentage': [typo_per_word],
+             'perturbed_word_percentage': [perturbed_word_percentage], 'total_typo': [typo_counter[level]],
+             'total_word': [word_counter], 'perturbed_word': perturbed_word[level]}
+        meta = pd.DataFrame(m)
+        meta.to_csv(f.name.replace('.txt', '-meta.csv'), sep=',', index=False)
+
+
+def perturb_file(perturbed, rumor_percentage, cleaned, hmm):
+    perturb_files([perturbed], [rumor_percentage], cleaned, hmm)
+
+
+def _count_tokens(text):
+    return Counter(text.split())
+
+
+def _spill_counts(counter, directory, n):
+    # Write counter sorted by word, to be merged later
+    filename = os.path.join(directory, "counts-{}.tsv".format(n))
+
+    with open(filename, "w") as f:
+        for word in sorted(counter):
+            f.write("{}\t{}\n".format(word, counter[word]))
+
+    return filename
+
+
+def _read_counts(filename):
+    with open(filename, "r") as f:
+        for line in f:
+            word, count = line.rstrip("\n").split("\t")
+            yield word, int(count)
 
 
-def create_model_language():
-    with open("../data/texts/lotr_clean.txt", "r") as myfile:
-        cleaned = myfile.readlines()
+def build_language_model(corpus, outfile, binary_file=None, chunk_size=1 << 22, nprocesses=None,
+                         spill_threshold=2000000, spill_dir=None):
+    # Word frequencies of corpus, written as word,prob rows in outfile and
+    # optionally in the binary format of lexicon.save_language_model.
+    # Chunks are counted in parallel and the partial counters merged. When the
+    # merged counter grows beyond spill_threshold words it's spilled to disk,
+    # and the spilled runs are merged at the end.
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+
+    print("Starting language model {} …".format(outfile))
+    start = time.time()
 
     counter = Counter()
     total_word = 0
 
-    for line in cleaned:
-        for word in line.split():
-            counter[word] += 1
-            total_word += 1
+    spill_directory = tempfile.mkdtemp(dir=spill_dir)
+    spills = []
+
+    try:
+        with multiprocessing.Pool(nprocesses) as pool, open(corpus, "r") as f:
+            chunks = read_token_chunks(f, chunk_size)
 
-    for el in counter:
-        counter[el] /= total_word
+            for partial in bounded_imap(pool, _count_tokens, chunks, 2 * nprocesses):
+                counter.update(partial)
+                total_word += sum(partial.values())
+
+                if len(counter) > spill_threshold:
+                    spills.append(_spill_counts(counter, spill_directory, len(spills)))
+                    counter.clear()
+
+        if spills:
+            if counter:
+                spills.append(_spill_counts(counter, spill_directory, len(spills)))
+                counter.clear()
+
+            runs = heapq.merge(*[_read_counts(s) for s in spills])
+            counts = ((word, sum(c for _, c in group)) for word, group in itertools.groupby(runs, key=lambda x: x[0]))
+        else:
+            counts = ((word, counter[word]) for word in sorted(counter))
+
+        with open(outfile, "w") as file:
+            writer = csv.writer(file)
+
+            def rows():
+                for word, count in counts:
+                    prob = count / total_word
+                    writer.writerow([word, prob])
+
+                    yield word, prob
+
+            if binary_file is None:
+                for _ in rows():
+                    pass
+            else:
+                lexicon.save_language_model(binary_file, rows())
+    finally:
+        shutil.rmtree(spill_directory)
+
+    end = time.time()
+    print("Ended language model in {:6.2f} seconds \n".format(end - start))
 
-    with open("../data/word_freq/lotr_language_model.txt", "w") as file:
-        writer = csv.writer(file)
 
-        for key, value in counter.items():
-            writer.writerow([key, value])
+def create_model_language(corpus="../data/texts/lotr_clean.txt", outfile="../data/word_freq/lotr_language_model.txt",
+                          binary_file=None):
+    build_language_model(corpus, outfile, binary_file)
 
 
 def split_list(lst, n):
@@ -218,70 +415,122 @@ def split_list(lst, n):
     return result
 
 
-def create_typo_dataset(typo_ds):
-    typo_writer = csv.writer(typo_ds)
+def bounded_imap(pool, func, iterable, window):
+    # Like pool.imap, but never submits more than `window` tasks ahead of the
+    # results consumed so far, so that the input is read lazily
+    pending = deque()
 
-    # Create a model for the test set
-    hmm = HMM(1, max_edits=2, max_states=3)
-    hmm.train(words_ds="../data/word_freq/lotr_language_model.txt",
-              sentences_ds="../data/texts/lotr_clean.txt",
-              typo_ds="../data/typo/clean/big_train.csv")
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
 
-    with open("../data/word_freq/lotr_language_model.txt", "r") as myfile:
-        reader = csv.reader(myfile)
-        words_ds = [row for row in reader]
+        if len(pending) >= window:
+            yield pending.popleft().get()
 
-    typo_dict = defaultdict()
+    while pending:
+        yield pending.popleft().get()
 
-    _, edit_prob = extract_model_edit_probabilities(hmm)
 
-    print("Starting perturb {} …".format(typo_ds.name))
-    start = time.time()
+def _typo_shard_init(_edit_prob):
+    global edit_prob
+
+    edit_prob = _edit_prob
+
+
+def _typo_shard(task):
+    shard_id, words, seed, n_typos, part_file = task
+
+    # Every shard has its own seed, so the output doesn't depend on the number
+    # of processes or on the order in which shards are processed
+    rng = np.random.default_rng([seed, shard_id])
+    random = RandomBuffer(rng)
+    sampler = EditSampler(edit_prob, random)
 
     typo_counter = 0
     word_counter = 0
 
-    for word in words_ds:
-        word = word[0]
-        orig_word = word
-        typos = list()
+    with open(part_file, "w") as f:
+        typo_writer = csv.writer(f)
 
-        for _ in range(5):
-            word = orig_word
+        for word in words:
             n = len(word)
-            # number of errors to introduce in the word
-            if n < 3:
-                x = 1
-            else:
-                x = np.random.randint(2) + 1
 
-            # choose two letter to change
-            indices = np.random.choice(n, x, replace=False)
-            indices = -np.sort(-indices)
+            for _ in range(n_typos):
+                # number of errors to introduce in the word
+                if n < 3:
+                    x = 1
+                else:
+                    x = random.randint(2) + 1
 
-            word = perturb_word(edit_prob, indices, word, x)
+                indices = sorted(random.sample(n, x), reverse=True)
+
+                typo_writer.writerow([sampler.perturb_word(word, indices), word])
+
+                typo_counter += x
+                word_counter += 1
+
+    return part_file, typo_counter, word_counter
+
+
+def create_typo_corpus(model_file, words_ds, typo_ds, n_typos=5, shard_size=10000, seed=0, nprocesses=None):
+    # Generate n_typos misspellings for each word of the language model words_ds,
+    # using the error model of a saved HMM. The vocabulary is split in shards of
+    # shard_size words processed in parallel and streamed to typo_ds in order.
+    hmm = HMM.load(model_file, setup_pool=False)
+
+    # Only the edit tables of the error model (FrozenMaps, picklable on their
+    # own) are sent to the worker processes
+    _, edit_prob = extract_model_edit_probabilities(hmm)
+    del hmm
 
-            typos.append(word)
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
 
-            typo_counter += x
-            word_counter += 1
+    def shards():
+        with open(words_ds, "r") as f:
+            reader = csv.reader(f)
+            words = []
+            shard_id = 0
 
-        typo_dict[orig_word] = typos
+            for row in reader:
+                if not row or not row[0]:
+                    continue
+
+                words.append(row[0])
+
+                if len(words) == shard_size:
+                    yield shard_id, words, seed, n_typos, "{}.part{}".format(typo_ds, shard_id)
+                    words = []
+                    shard_id += 1
+
+            if words:
+                yield shard_id, words, seed, n_typos, "{}.part{}".format(typo_ds, shard_id)
+
+    print("Starting perturb {} …".format(typo_ds))
+    start = time.time()
+
+    typo_counter = 0
+    word_counter = 0
+
+    with multiprocessing.Pool(nprocesses, initializer=_typo_shard_init, initargs=[edit_prob]) as pool, \
+            open(typo_ds, "w") as out:
+
+        for part_file, typos, words in bounded_imap(pool, _typo_shard, shards(), 2 * nprocesses):
+            with open(part_file, "r") as part:
+                shutil.copyfileobj(part, out)
+
+            os.remove(part_file)
+
+            typo_counter += typos
+            word_counter += words
 
     end = time.time()
     perturb_time = end - start
 
-    for key, value in typo_dict.items():
-        for v in value:
-            typo_writer.writerow([v, key])
-
     print("Ended perturbation in {:6.2f} seconds \n".format(perturb_time))
 
     typo_per_word = typo_counter / word_counter
 
-    m = {'file': [typo_ds.name], 'typo_percentage': [typo_per_word], 'total_typo': [typo_counter],
+    m = {'file': [typo_ds], 'typo_percentage': [typo_per_word], 'total_typo': [typo_counter],
          'total_word': [word_counter]}
     meta = pd.DataFrame(m)
-    meta.to_csv(typo_ds.name.replace('.csv', '-meta.csv'), sep=',', index=False)
-
-    typo_ds.close()
+    meta.to_csv(typo_ds.replace('.csv', '-meta.csv'), sep=',', index=False)